@@ -1,22 +1,411 @@
+import base64
+import calendar
 import uuid
 import warnings
 import json
-from bs4 import BeautifulSoup
+import time
+import threading
+import inspect
+import re
+from urllib.parse import parse_qsl, urlparse
+from collections.abc import Sequence
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial, wraps
 from BaseAPI import BaseAPI
+from HypeMCache import MemoryCache, MISSING
+from HypeMTransport import RequestsTransport
+
+
+class _CacheHit(Exception):
+    '''Raised from a request to end a memoized call with its cached value'''
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _MemoFrame(object):
+    '''A memoized call in progress. Its key is set from the first request
+    the call makes, as that request is fully resolved'''
+
+    def __init__(self, name, defaults):
+        self.name = name
+        self.defaults = defaults
+        self.key = None
+
+
+_memo_frames = threading.local()
+
+
+def _memoize(f):
+    '''Wraps a method to read from the memo cache backend. Unlike
+    BaseAPI._memoize, the key is not built from the raw args but from the
+    method name and the first request the method makes: its path plus its
+    sorted query params, without params equal to the method's defaults. So
+    aliases, positional/keyword args, ints/strings and hm_token=None vs. the
+    instance's token all share one entry. Methods that make no GET or scrape
+    request are not cached.'''
+    defaults = {name: str(param.default) for name, param in
+                inspect.signature(f).parameters.items()
+                if param.default not in (None, inspect.Parameter.empty)}
+
+    @wraps(f)
+    def memoized(*args, **kwargs):
+        instance = args[0]
+        frames = getattr(_memo_frames, 'stack', None)
+        if frames is None:
+            frames = _memo_frames.stack = []
+        frame = _MemoFrame(f.__name__, defaults)
+        frames.append(frame)
+        try:
+            result = f(*args, **kwargs)
+        except _CacheHit as hit:
+            return hit.value
+        finally:
+            frames.pop()
+        if frame.key is not None:
+            ttl = getattr(_memo_frames, 'ttl', None)
+            if ttl is None:
+                ttl = instance._ttl(frame.key)
+                if hasattr(f, 'result_ttl'):
+                    ttl = f.result_ttl(instance, result, ttl)
+            if ttl > 0:
+                instance.memo.set(frame.key, result, ttl)
+            stored = getattr(_memo_frames, 'stored', None)
+            if stored is not None:
+                stored.append((frame.key, ttl))
+        return result
+
+    memoized.debug = f
+    return memoized
+
+
+def _invalidates(*names):
+    '''Marks a mutating method as making the memoized results of the named
+    read methods stale. After the method succeeds, those entries are dropped
+    for the hm_token it was called with. The instance's token is read once,
+    before the call, so that a concurrent get_token cannot make the call
+    and the invalidation use different tokens.'''
+
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @wraps(f)
+        def invalidating(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            instance = args[0]
+            hm_token = bound.arguments.get('hm_token') or instance.hm_token
+            bound.arguments['hm_token'] = hm_token
+            result = f(*bound.args, **bound.kwargs)
+            instance.invalidate(*names, hm_token=hm_token)
+            return result
+
+        invalidating.invalidates = names
+        return invalidating
+
+    return decorator
+
+
+def _result_ttl(ttl_function):
+    '''Lets a memoized method's result decide how long it is cached:
+    ttl_function(instance, result, ttl) returns the lifetime of result, given
+    the lifetime from cache_life and cache_policy. Apply under _memoize.'''
+
+    def decorator(f):
+        f.result_ttl = ttl_function
+        return f
+
+    return decorator
+
+
+def _url_expiry(url):
+    '''Returns the unix time at which a signed url expires, read from its
+    query (Expires=..., X-Amz-Date + X-Amz-Expires, or a CloudFront
+    Policy), or None if it has no recognizable expiry'''
+    query = dict(parse_qsl(urlparse(url).query))
+    for param in ('Expires', 'expires', 'expire', 'exp', 'e'):
+        if query.get(param, '').isdigit():
+            return int(query[param])
+    if 'X-Amz-Date' in query and query.get('X-Amz-Expires', '').isdigit():
+        signed = datetime.strptime(query['X-Amz-Date'], '%Y%m%dT%H%M%SZ')
+        return (calendar.timegm(signed.timetuple()) +
+                int(query['X-Amz-Expires']))
+    if 'Policy' in query:
+        policy = query['Policy'].replace('-', '+').replace('_', '=')
+        policy = policy.replace('~', '/')
+        try:
+            statement = json.loads(base64.b64decode(policy))['Statement'][0]
+            return int(statement['Condition']['DateLessThan']['AWS:EpochTime'])
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
+    return None
+
+
+def _stream_ttl(instance, url, ttl):
+    '''Caches a stream url until shortly before it expires, and the absence
+    of a stream for stream_negative_life'''
+    if not url:
+        return min(ttl, instance.stream_negative_life)
+    expiry = _url_expiry(url)
+    if expiry is None:
+        return ttl
+    return min(ttl, expiry - instance.stream_expiry_margin - time.time())
+
+
+def _memo_key(name, path, defaults={}):
+    '''Returns the canonical memo key of a request made by the method
+    name: (name, path, sorted ((param, value), ...)), omitting empty params
+    and params equal to the method's defaults'''
+    path, _, query = path.partition('?')
+    params = tuple(sorted((k, v) for k, v in parse_qsl(query)
+                          if defaults.get(k) != v))
+    return (name, path, params)
+
+
+def _soup(html, parser='lxml'):
+    # imported here so that API-only users never pay for bs4 and lxml
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, parser)
+
+
+def _track_tags(soup):
+    tag_box = soup.find('ul', 'tags')
+    if not tag_box:
+        return []
+    return [tag.text for tag in tag_box.find_all('li')]
+
+
+def _track_source(soup):
+    display_list = soup.find(id='displayList-data')
+    if display_list is None:
+        return None
+    # the display list may hold more tracks, but the 1st is the page's
+    track_json = json.loads(display_list.text)['tracks'][0]
+    if not track_json['type']:
+        # type is false if the stream is no longer available
+        return None
+    return track_json['id'], track_json['key']
+
+
+def parse_track_tags(html, parser='lxml'):
+    '''Returns the genre tags listed on the HTML of a hypem.com track page.
+    A module-level function, so that it can run in a process pool.'''
+    return _track_tags(_soup(html, parser))
+
+
+def parse_track_source(html, parser='lxml'):
+    '''Returns (id, key) of the stream of the track of a hypem.com track
+    page, or None if the page has no stream or it is no longer available.
+    A module-level function, so that it can run in a process pool.'''
+    return _track_source(_soup(html, parser))
+
+
+def parse_track_page(html, parser='lxml'):
+    '''Returns the results of parse_track_tags and parse_track_source for
+    a hypem.com track page, from a single parse, keyed by function name'''
+    soup = _soup(html, parser)
+    return {'parse_track_tags': _track_tags(soup),
+            'parse_track_source': _track_source(soup)}
+
+
+# parse functions whose results parse_track_page returns
+_PAGE_PARSES = ('parse_track_tags', 'parse_track_source')
+
+
+class RequestHook(object):
+    '''Base class for request lifecycle hooks. Subclasses override before
+    and/or after, which are passed the context dict of a phase:
+        'phase': one of 'encode', 'cache', 'get', 'post', 'delete', 'soup',
+            'network', 'decode', 'parse'
+        'start': time.perf_counter() at the start of the phase
+        'end', 'elapsed': set before after() is called
+        'error': the exception raised during the phase, if any
+    plus phase-specific values such as 'url', 'method', 'hit' or 'status'.
+    Phases nest: a 'get' phase contains its 'network' and 'decode' phases.'''
+
+    def before(self, context):
+        pass
+
+    def after(self, context):
+        pass
+
+
+class SpanEmitter(RequestHook):
+    '''Emits an OpenTelemetry span for every request phase. Phase-specific
+    values of the context are recorded as 'hypem.*' span attributes.
+    Requires opentelemetry-api unless a tracer is passed.'''
+
+    def __init__(self, tracer=None):
+        '''
+        Args:
+            Optional:
+            tracer: an OpenTelemetry tracer (or anything with a compatible
+                start_as_current_span method); defaults to the global
+                tracer provider's 'HypeM' tracer
+        '''
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer('HypeM')
+        self._tracer = tracer
+        self._local = threading.local()
+
+    def before(self, context):
+        span_manager = self._tracer.start_as_current_span(
+            'hypem.' + context['phase'])
+        span = span_manager.__enter__()
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append((span_manager, span))
+
+    def after(self, context):
+        span_manager, span = self._local.stack.pop()
+        for k, v in context.items():
+            if isinstance(v, (str, bool, int, float)):
+                span.set_attribute('hypem.' + k, v)
+        error = context.get('error')
+        if error is None:
+            span_manager.__exit__(None, None, None)
+        else:
+            span_manager.__exit__(type(error), error, error.__traceback__)
+
+
+# a JSON object without nested objects (arrays of scalars are fine). Each
+# character can only match one part of the pattern, so it does not
+# backtrack exponentially on objects that turn out to be nested.
+_FLAT_OBJECT = re.compile(
+    r'\{[^{}"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^{}"]*)*\}')
+_SEPARATOR = re.compile(r'[\s,]*')
+
+
+class LazyList(Sequence):
+    '''A JSON array response that is decoded one item at a time, when the
+    item is first accessed. Keeps the response text and an index of item
+    offsets, which is extended only as far as the items accessed, so
+    reading the first few tracks of a count=100 page decodes only those.
+
+    pluck(field) projects one field of every item without decoding them.'''
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, text, wrap=None):
+        '''
+        Args:
+            string text: a JSON array
+            Optional:
+            function wrap: applied to each item once decoded
+        '''
+        self._text = text
+        self._wrap = wrap
+        self._spans = []  # (start, end, flat) of the items indexed so far
+        self._items = {}  # index -> decoded item
+        self._pos = text.index('[') + 1
+        self._complete = False
+        self._lock = threading.Lock()
+
+    def _index(self, stop=None):
+        '''Indexes items until there are more than stop, or all if None'''
+        with self._lock:
+            text, spans = self._text, self._spans
+            while not self._complete and (stop is None or len(spans) <= stop):
+                start = _SEPARATOR.match(text, self._pos).end()
+                if text[start] == ']':
+                    self._complete = True
+                    break
+                match = _FLAT_OBJECT.match(text, start)
+                if match is not None:
+                    spans.append((start, match.end(), True))
+                else:
+                    # a nested object or another type: decode it to find
+                    # its end, and keep it
+                    item, end = self._decoder.raw_decode(text, start)
+                    self._items[len(spans)] = self._finish(item)
+                    spans.append((start, end, False))
+                self._pos = spans[-1][1]
+
+    def _finish(self, item):
+        return item if self._wrap is None else self._wrap(item)
+
+    def _item(self, i):
+        item = self._items.get(i, MISSING)
+        if item is MISSING:
+            start = self._spans[i][0]
+            item = self._items.setdefault(
+                i, self._finish(self._decoder.raw_decode(self._text,
+                                                         start)[0]))
+        return item
+
+    def __len__(self):
+        self._index()
+        return len(self._spans)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0:
+            raise IndexError('list index out of range')
+        self._index(i)
+        if i >= len(self._spans):
+            raise IndexError('list index out of range')
+        return self._item(i)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return 'LazyList({!r})'.format(list(self))
+
+    def pluck(self, field, default=None):
+        '''Returns the value of field in every item, or default for items
+        without it. Items that are not yet decoded are left undecoded.'''
+        key = re.compile(r'"{}"\s*:\s*'.format(
+            re.escape(json.dumps(field)[1:-1])))
+        self._index()
+        values = []
+        for i, (start, end, flat) in enumerate(self._spans):
+            item = self._items.get(i, MISSING)
+            if item is MISSING and flat:
+                # a flat object's only "field": is its key
+                match = key.search(self._text, start, end)
+                values.append(default if match is None else
+                              self._decoder.raw_decode(self._text,
+                                                       match.end())[0])
+            else:
+                item = self._item(i)
+                values.append(item.get(field, default)
+                              if isinstance(item, dict) else default)
+        return values
 
 
 class HypeM(BaseAPI):
-    '''Wrapper for the public HypeM RESTful HTTP API'''
-    memo = {}  # used to cache method calls
+    '''Wrapper for the public HypeM RESTful HTTP API
+
+    An instance may be shared by threads: the memo is thread-safe, each
+    thread sends through its own session (sharing connection pools), and
+    authenticated methods read the instance's hm_token once per call, so a
+    concurrent get_token or signup changes the token of later calls only.'''
+    memo = MemoryCache()  # used to cache method calls
 
     test_song = '2fv7a'
     test_blog = 22830
     test_artist = 'ratherbright'
     test_tag = 'indie'
 
+    # get_track_stream urls are cached until this many seconds before the
+    # expiry signed into them, and '' (no stream) for stream_negative_life
+    stream_expiry_margin = 60
+    stream_negative_life = 600
+
+    html_parser = 'lxml'  # BeautifulSoup parser of scraped pages
+
     def __init__(self, username=None, password=None,
                  hm_token=None, payload_auth={'key': 'swagger'},
-                 cache_life=3600):
+                 cache_life=3600, cache_policy=None, cache=None,
+                 transport=None, identity_map=None, lazy_lists=False,
+                 parse_pool=None):
         '''
         Args:
             Optional:
@@ -27,6 +416,26 @@ class HypeM(BaseAPI):
             number cache_life: length of time in seconds that a method call is
                 retrieved from a cache before being retrieved from the server
                 again
+            dict cache_policy: cache_life overrides, keyed by method name
+                (eg 'popular' or its alias 'get_popular') or by endpoint
+                category with a leading slash (eg '/me', '/tags'). Method
+                names take precedence. A value of 0 disables caching.
+                eg {'/me': 0, 'list_tags': 86400, 'item': float('inf')}
+            CacheBackend cache: backend of this instance's memo, eg a
+                RedisCache shared by many processes (defaults to the
+                MemoryCache shared by all instances, HypeM.memo)
+            Transport transport: HTTP transport requests are sent with, eg
+                an HttpxTransport for HTTP/2 (defaults to a RequestsTransport
+                with a session per thread, configured like this instance's
+                requests session)
+            TrackIdentityMap identity_map: map merging the fields intrinsic
+                to the tracks of GET responses into one shared record per
+                itemid, to save memory when cached listings overlap
+            bool lazy_lists: return GET responses that are JSON arrays as
+                LazyLists, decoding their items only when accessed
+            Executor parse_pool: executor the HTML of scraped pages is
+                parsed in, eg a ProcessPoolExecutor so that threads scraping
+                in parallel are not serialized by parsing under the GIL
             '''
         super(HypeM, self).__init__('https://api.hypem.com/v2/',
                                     payload_auth=payload_auth,
@@ -38,10 +447,210 @@ class HypeM(BaseAPI):
             self.hm_token = hm_token
         else:
             self.hm_token = ''
+        self.hooks = []
+        if transport is None:
+            transport = RequestsTransport(self._session, per_thread=True)
+        self.transport = transport
+        self.identity_map = identity_map
+        self.lazy_lists = lazy_lists
+        self.parse_pool = parse_pool
+        if cache is not None:
+            self.memo = cache
+        self._cache_policy = {}
+        for name, ttl in (cache_policy or {}).items():
+            method = getattr(type(self), name, None)
+            if not name.startswith('/') and callable(method):
+                # resolve aliases to the name the memo is keyed by
+                name = method.__name__
+            self._cache_policy[name] = ttl
         if username and password and not self.hm_token:
             self.hm_token = self.get_token(
                 username=username, password=password)
 
+    def add_hook(self, hook):
+        '''Registers a RequestHook to be called around every request phase
+        of this instance'''
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        '''Unregisters a previously added RequestHook'''
+        self.hooks.remove(hook)
+
+    @contextmanager
+    def _span(self, phase, **context):
+        '''Times the enclosed block as a request phase, calling the before
+        and after methods of registered hooks. Yields the phase's context
+        dict, which the block may add values to'''
+        if not self.hooks:
+            yield context
+            return
+        hooks = list(self.hooks)
+        context['phase'] = phase
+        context['start'] = time.perf_counter()
+        for hook in hooks:
+            hook.before(context)
+        try:
+            yield context
+        except Exception as e:
+            context['error'] = e
+            raise
+        finally:
+            context['end'] = time.perf_counter()
+            context['elapsed'] = context['end'] - context['start']
+            for hook in reversed(hooks):
+                hook.after(context)
+
+    def _param(self, param, value):
+        '''Formats a parameter/value pair for html, like BaseAPI._param, but
+        keeps zeros (eg fav_from=0), dropping only None, False and empty
+        values'''
+        if value is None or value is False or value == '':
+            return ''
+        return str(param) + '=' + str(value) + '&'
+
+    def _parse_params(self, locals_copy, exclude_endpoints=[]):
+        with self._span('encode'):
+            return super(HypeM, self)._parse_params(locals_copy,
+                                                    exclude_endpoints)
+
+    def _parse_payload(self, locals_copy, exclude_endpoints=[]):
+        with self._span('encode'):
+            return super(HypeM, self)._parse_payload(locals_copy,
+                                                     exclude_endpoints)
+
+    def _send(self, http_method, url, **kwargs):
+        '''Performs a request with the transport and checks its status,
+        timing it as the 'network' phase. Transports do not expose connection
+        acquisition separately, so it is included here; the server's time to
+        respond is reported as 'server_elapsed'.'''
+        with self._span('network', url=url) as context:
+            response = self.transport.request(http_method, url, **kwargs)
+            context['status'] = response.status_code
+            elapsed = getattr(response, 'elapsed', None)
+            if elapsed is not None:
+                context['server_elapsed'] = elapsed.total_seconds()
+        self._check_status(response)
+        return response
+
+    def _decode(self, response):
+        with self._span('decode'):
+            return json.loads(response.text)
+
+    def _ttl(self, key):
+        '''Returns how long in seconds the memo entry with key stays fresh,
+        from the cache_policy of its method, then of its category, falling
+        back to cache_life'''
+        name, path, _ = key
+        if name in self._cache_policy:
+            return self._cache_policy[name]
+        category = '/' + path.split('/', 1)[0]
+        return self._cache_policy.get(category, self._cache_life)
+
+    @contextmanager
+    def cache_for(self, ttl):
+        '''Within the block, results memoized by the current thread are
+        kept for ttl seconds, overriding cache_life and cache_policy (unless
+        ttl is None). eg
+        with hm.cache_for(float('inf')): hm.get_tag_tracks(...)'''
+        previous = getattr(_memo_frames, 'ttl', None)
+        _memo_frames.ttl = ttl
+        try:
+            yield
+        finally:
+            _memo_frames.ttl = previous
+
+    @contextmanager
+    def refreshing(self):
+        '''Within the block, memoized calls made by the current thread skip
+        the memo and fetch from the server, storing their fresh results.
+        Yields a list to which the (key, ttl) of each result memoized in the
+        block is appended.'''
+        previous = (getattr(_memo_frames, 'refresh', False),
+                    getattr(_memo_frames, 'stored', None))
+        _memo_frames.refresh = True
+        _memo_frames.stored = []
+        try:
+            yield _memo_frames.stored
+        finally:
+            _memo_frames.refresh, _memo_frames.stored = previous
+
+    def invalidate(self, *names, hm_token=None):
+        '''Drops memoized results of the named methods (aliases allowed)
+        so that they are fetched again on the next call.
+
+        Args:
+            strings names: names of memoized methods
+            Optional:
+            string hm_token: only drop results requested with this token
+        '''
+        for name in set(getattr(type(self), name).__name__ for name in names):
+            self.memo.delete_method(name, hm_token)
+
+    def _check_memo(self, path):
+        '''Keys the innermost memoized call by its first request, and ends
+        the call with the cached value if there is a fresh one'''
+        frames = getattr(_memo_frames, 'stack', None)
+        if not frames or frames[-1].key is not None:
+            return
+        frame = frames[-1]
+        frame.key = _memo_key(frame.name, path, frame.defaults)
+        if getattr(_memo_frames, 'refresh', False):
+            return
+        with self._span('cache', method=frame.name,
+                        key=frame.key) as context:
+            value = self.memo.get(frame.key)
+            context['hit'] = value is not MISSING
+        if context['hit']:
+            raise _CacheHit(value)
+
+    def _get(self, qstring):
+        '''Handles auth, API query, status checking, and json conversion.
+        May raise an exception depending on response status code.
+        Returns response as JSON
+
+        Args:
+            string qstring: string for API query without auth key
+        '''
+        self._check_memo(qstring)
+        with self._span('get', url=qstring):
+            qstring += self._key
+            response = self._send('GET', self._api + qstring,
+                                  headers=self._headers)
+            wrap = None
+            if self.identity_map is not None:
+                # tracks carry per-account fields: share them per token
+                token = dict(parse_qsl(urlparse(qstring).query)).get(
+                    'hm_token', '')
+                wrap = partial(self.identity_map.intern, hm_token=token)
+            if self.lazy_lists and response.text.lstrip()[:1] == '[':
+                return LazyList(response.text, wrap)
+            result = self._decode(response)
+            return result if wrap is None else wrap(result)
+
+    def _put_post_delete(self, endpoint, payload, http_method):
+        '''Sends a put/post/delete request with the specified payload
+        and returns the response as JSON if it is valid
+
+        Args:
+            string endpoint: URL of API endpoint
+            dict payload: dict of payload data
+            string http_method: 'PUT', 'POST' or 'DELETE'
+        '''
+        with self._span(http_method.lower(), url=endpoint):
+            payload.update(self._payload_auth)
+            response = self._send(http_method, self._api + endpoint,
+                                  data=payload, headers=self._headers)
+            return self._decode(response)
+
+    def _put(self, endpoint, payload):
+        return self._put_post_delete(endpoint, payload, 'PUT')
+
+    def _post(self, endpoint, payload):
+        return self._put_post_delete(endpoint, payload, 'POST')
+
+    def _delete(self, endpoint, payload):
+        return self._put_post_delete(endpoint, payload, 'DELETE')
+
     def _assert_hm_token(self, hm_token):
         if not hm_token:
             hm_token = self.hm_token
@@ -50,7 +659,7 @@ class HypeM(BaseAPI):
 
     ''' /artists '''
 
-    @BaseAPI._memoize
+    @_memoize
     def popular_artists(self, sort='popular', page=None, count=None,
                         hm_token=None):
         """Popular Artists
@@ -76,7 +685,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_artist_info(self, artist, hm_token=None):
         """Get artist metadata
         Get artist metadata like artist thumbnail. Artist must be URI encoded
@@ -96,7 +705,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_artist_tracks(self, artist, page=None, count=None, hm_token=None):
         """Get artist tracks
         Artist must be URI encoded
@@ -120,7 +729,7 @@ class HypeM(BaseAPI):
 
     ''' /blogs '''
 
-    @BaseAPI._memoize
+    @_memoize
     def list_blogs(self, hydrate=None, page=None, count=None, hm_token=None):
         """List all blogs
         Lists all blogs currently tracked by Hype Machine. Not paginated by
@@ -146,7 +755,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def list_blogs_count(self, hm_token=None):
         """Get count of blogs
         Get total count of blogs in directory (useful for pagination)
@@ -166,7 +775,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_site_info(self, siteid, hm_token=None):
         """Get blog metadata
         Get blog information like url, number of subscribers, etc
@@ -186,7 +795,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_blog_tracks(self, siteid, page=None, count=None, hm_token=None):
         """Get blog tracks
 
@@ -210,7 +819,7 @@ class HypeM(BaseAPI):
 
     ''' /featured '''
 
-    @BaseAPI._memoize
+    @_memoize
     def featured(self, type='all', page=None, count=None, hm_token=None):
         """Get featured things, interleaved or separated
         count and page are only meaningful in 'premieres' mode, otherwise we
@@ -240,7 +849,7 @@ class HypeM(BaseAPI):
 
     ''' /me '''
 
-    @BaseAPI._memoize
+    @_memoize
     def favorites_me(self, hm_token=None, page=None, count=None):
         """Get my favorites
 
@@ -262,6 +871,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
+    @_invalidates('favorites_me')
     def toggle_favorite(self, type, val, hm_token=None):
         """Add to favorites
         Returns 1 or 0, reflecting the final state of the item (1 is favorite,
@@ -288,7 +898,7 @@ class HypeM(BaseAPI):
 
         return self._post(endpoint, payload)
 
-    @BaseAPI._memoize
+    @_memoize
     def playlist_me(self, playlist_id, hm_token=None, page=None, count=None):
         """Get items in my playlist
         Playlist names are available at /me/playlist_names
@@ -314,6 +924,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
+    @_invalidates('playlist_me', 'favorites_me')
     def add_playlist(self, playlist_id, itemid, hm_token=None):
         """Add item to playlist
         Returns 1 or 0, reflecting success and failure, respectively. Will also
@@ -342,6 +953,7 @@ class HypeM(BaseAPI):
 
         return self._post(endpoint, payload)
 
+    @_invalidates('playlist_me')
     def remove_playlist(self, playlist_id, itemid, hm_token=None):
         """Remove item from playlist
         Returns 1 or 0, reflecting success and failure, respectively. Will NOT
@@ -367,11 +979,11 @@ class HypeM(BaseAPI):
             locals().copy(), ['playlist_id', 'itemid'])
         # defined after payload bc of locals() call
         endpoint = ('me/playlists/' + str(playlist_id) + '/items/' +
-                    str(itemid) + '?' + self._param('hm_token', self.hm_token))
+                    str(itemid) + '?' + self._param('hm_token', hm_token))
 
         return self._delete(endpoint, payload)
 
-    @BaseAPI._memoize
+    @_memoize
     def history_me(self, hm_token=None, sort='latest', page=None, count=None):
         """Get my history
 
@@ -398,6 +1010,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
+    @_invalidates('history_me')
     def log_user_action(self, type, itemid, pos, hm_token=None, ts=None):
         """Add user action to history
         Log an action to site history, currently only listen events but
@@ -423,11 +1036,11 @@ class HypeM(BaseAPI):
         assert str(type) in ['listen'], '"type" must be listen'
 
         payload = self._parse_payload(locals().copy(), [])
-        endpoint = 'me/history?' + self._param('hm_token', self.hm_token)
+        endpoint = 'me/history?' + self._param('hm_token', hm_token)
 
         return self._post(endpoint, payload)
 
-    @BaseAPI._memoize
+    @_memoize
     def friends_me(self, hm_token=None, count=None, page=None):
         """Get my friends
         Not paginated by default, but accepts page and count parameters as
@@ -450,7 +1063,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def feed(self, hm_token=None, mode='all'):
         """Get my subscriptions feed
 
@@ -475,7 +1088,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def feed_count(self, hm_token=None):
         """Get number of "unread" items in my feed
 
@@ -496,6 +1109,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
+    @_invalidates('feed_count')
     def reset_feed_count(self, hm_token=None):
         """Reset number of "unread" items in my feed to zero
 
@@ -631,7 +1245,6 @@ class HypeM(BaseAPI):
         self.hm_token = self._post(endpoint, payload)
         return self.hm_token
 
-    @BaseAPI._memoize
     def get_token(self, username=None, password=None, fb_oauth_token=None,
                   tw_oauth_token=None, tw_oauth_token_secret=None):
         """Obtain an auth token
@@ -665,7 +1278,7 @@ class HypeM(BaseAPI):
 
     ''' /set '''
 
-    @BaseAPI._memoize
+    @_memoize
     def get_tracks_in_set(self, setname, hm_token=None):
         """Get tracks in a previously defined set specified by setname
 
@@ -688,7 +1301,7 @@ class HypeM(BaseAPI):
 
     ''' /tags '''
 
-    @BaseAPI._memoize
+    @_memoize
     def list_tags(self, hm_token=None):
         """List all tags
 
@@ -709,7 +1322,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_tag_info(self, tag, hm_token=None):
         """Get blog metadata
         Get blog information like url, number of subscribers, etc
@@ -731,7 +1344,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_tag_tracks(self, tag, fav_from=None, fav_to=None, page=None,
                        count=None, hm_token=None):
         """Get latest tracks for the tag
@@ -759,7 +1372,7 @@ class HypeM(BaseAPI):
 
     ''' /tracks '''
 
-    @BaseAPI._memoize
+    @_memoize
     def latest(self, q=None, sort='latest', page=None, count=None,
                hm_token=None):
         """Tracks
@@ -794,7 +1407,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def item(self, itemid, hm_token=None):
         """Single track
         Single track
@@ -814,7 +1427,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def item_blogs(self, itemid, hm_token=None):
         """Posting blogs
         Blogs that posted this track
@@ -834,7 +1447,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def item_users(self, itemid, hm_token=None):
         """Favoriting Users
         Users that favorited this track
@@ -854,7 +1467,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def popular(self, mode='now', page=None, count=None, hm_token=None):
         """Popular tracks
         Various popular charts: 3 day top 50 ('now'), calendar last week
@@ -886,7 +1499,7 @@ class HypeM(BaseAPI):
 
     ''' /users '''
 
-    @BaseAPI._memoize
+    @_memoize
     def search_users(self, q=None, hm_token=None):
         """Search users
         Does not return anything without a query param
@@ -907,7 +1520,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_user(self, username, hm_token=None):
         """Get user metadata
         Get user information like url, number of subscribers, etc
@@ -927,7 +1540,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_user_tracks(self, username, page=None, count=None, hm_token=None):
         """Get the user's favorites
 
@@ -949,7 +1562,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def playlis(self, username, playlist_id, page=None, count=None):
         """Get items in the user's playlist
 
@@ -977,7 +1590,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_user_history(self, username, page=None, count=None, hm_token=None):
         """Get the user's play history
 
@@ -999,7 +1612,7 @@ class HypeM(BaseAPI):
 
         return self._get(query_string)
 
-    @BaseAPI._memoize
+    @_memoize
     def get_user_friends(self, username, hm_token=None, count=None, page=None):
         """Get the user's friends
         Not paginated by default, but accepts page and count parameters as
@@ -1026,29 +1639,53 @@ class HypeM(BaseAPI):
 
     def _get_soup(self, url):
         '''Returns a BeautifulSoup object for a given URL'''
-        req = self._session.get(url)
-        self._check_status(req)
-        return BeautifulSoup(req.text, 'lxml')
-
-    @BaseAPI._memoize
+        return self._scrape(url, _soup)
+
+    def _scrape(self, url, parse):
+        '''Fetches the page at url and returns parse(html, html_parser),
+        run in parse_pool if the instance has one. Within _sharing_pages,
+        track pages are fetched and parsed once for all parse functions.'''
+        self._check_memo(url)
+        pages = getattr(_memo_frames, 'pages', None)
+        if pages is None or parse.__name__ not in _PAGE_PARSES:
+            return self._fetch_parse(url, parse)
+        if url not in pages:
+            pages[url] = self._fetch_parse(url, parse_track_page)
+        return pages[url][parse.__name__]
+
+    def _fetch_parse(self, url, parse):
+        with self._span('soup', url=url):
+            req = self._send('GET', url)
+            with self._span('parse'):
+                if self.parse_pool is None:
+                    return parse(req.text, self.html_parser)
+                return self.parse_pool.submit(parse, req.text,
+                                              self.html_parser).result()
+
+    @contextmanager
+    def _sharing_pages(self):
+        '''Within the block, the scraping methods called by this thread
+        share each track page: it is fetched and parsed once, by
+        parse_track_page, while each method's result is memoized as usual'''
+        previous = getattr(_memo_frames, 'pages', None)
+        _memo_frames.pages = {}
+        try:
+            yield
+        finally:
+            _memo_frames.pages = previous
+
+    @_memoize
     def get_track_tags(self, track_id):
         '''Scrapes the tags for a given, if any
         Args:
             - string track_id: track id of the song on HypeM
         Returns list of genre tags.'''
 
-        genre_tags = []
-        soup = self._get_soup('http://hypem.com/track/' + track_id)
-        tag_box = soup.find('ul', 'tags')
-        if not tag_box:
-            return genre_tags
-        tags = tag_box.find_all('li')
-        if tags:
-            for tag in tags:
-                genre_tags.append(tag.text)
-        return genre_tags
-
-    @BaseAPI._memoize
+        return self._scrape('http://hypem.com/track/' + track_id,
+                            parse_track_tags)
+
+    @_memoize
+    @_result_ttl(_stream_ttl)
     def get_track_stream(self, track_id):
         '''Scrapes the link to the raw mp3 of a track.
         Args:
@@ -1056,28 +1693,17 @@ class HypeM(BaseAPI):
         credit to @fzakaria: https://github.com/fzakaria/HypeScript
         Returns url to mp3 stream'''
 
-        soup = self._get_soup('http://hypem.com/track/' + track_id)
-        display_list = soup.find(id='displayList-data')
-        if display_list is None:
-            # if there is no display list, return empty string
-            return ''
-        # load the display_list variable as json, and get 1st element
-        # (there may be more elements in display_list, but 1st should
-        # be the specified track)
-        track_list = json.loads(display_list.text)
-        track_json = track_list['tracks'][0]
-        key = track_json['key']
-        id_ = track_json['id']
-        type_ = track_json['type']
-        if not type_:
-            # type_ is false if stream no longer available
+        source = self._scrape('http://hypem.com/track/' + track_id,
+                              parse_track_source)
+        if source is None:
+            # no display list, or the stream is no longer available
             return ''
         # get hypem to serve stream url
-        serve_url = 'http://hypem.com/serve/source/{}/{}'.format(id_, key)
-        song_data_response = self._session.get(serve_url,
-                                               headers={'Content-Type':
-                                                        'application/json'})
-        song_data = json.loads(song_data_response.text)
+        serve_url = 'http://hypem.com/serve/source/{}/{}'.format(*source)
+        song_data_response = self._send('GET', serve_url,
+                                        headers={'Content-Type':
+                                                 'application/json'})
+        song_data = self._decode(song_data_response)
         return song_data.get('url')
 
     ''' Aliases: methods renamed from HypeM nicknames '''
@@ -0,0 +1,560 @@
+'''Cache backends for the HypeM memo'''
+import json
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from collections.abc import ItemsView, KeysView, Mapping, ValuesView
+
+MISSING = object()  # returned by backends for absent or expired keys
+
+
+class CacheBackend(object):
+    '''Interface of memo backends. Keys are HypeM memo keys: tuples of
+    (method name, path, ((param, value), ...)). Values are JSON results,
+    possibly with LazyLists, which serializing backends store as lists.
+    A ttl is in seconds and may be float('inf').'''
+
+    def get(self, key, default=MISSING):
+        '''Returns the value stored under key, or default if there is none
+        or it has expired'''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        '''Stores value under key for ttl seconds'''
+        raise NotImplementedError
+
+    def delete(self, key):
+        '''Removes key, if present'''
+        raise NotImplementedError
+
+    def keys(self):
+        '''Returns an iterable of the stored keys'''
+        raise NotImplementedError
+
+    def clear(self):
+        '''Removes every key'''
+        for key in list(self.keys()):
+            self.delete(key)
+
+    def get_many(self, keys, default=MISSING):
+        '''Returns a list of the values of keys, with default for misses'''
+        return [self.get(key, default) for key in keys]
+
+    def set_many(self, items, ttl):
+        '''Stores each (key, value) of the dict items for ttl seconds'''
+        for key, value in items.items():
+            self.set(key, value, ttl)
+
+    def delete_method(self, name, hm_token=None):
+        '''Removes the entries of the method name, or only those requested
+        with hm_token if it is given'''
+        for key in list(self.keys()):
+            if key[0] == name and (not hm_token or
+                                   ('hm_token', str(hm_token)) in key[2]):
+                self.delete(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not MISSING
+
+
+class _KeyIndex(object):
+    '''The stored keys of a backend by method name and hm_token, so that
+    delete_method does not scan every key'''
+
+    def __init__(self):
+        self._keys = {}  # name -> {hm_token: set of keys}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bucket(key):
+        if not isinstance(key, tuple) or len(key) != 3:
+            return None, None
+        return key[0], dict(key[2]).get('hm_token', '')
+
+    def add(self, key):
+        name, token = self._bucket(key)
+        if name is not None:
+            with self._lock:
+                self._keys.setdefault(name, {}).setdefault(
+                    token, set()).add(key)
+
+    def discard(self, key):
+        name, token = self._bucket(key)
+        with self._lock:
+            keys = self._keys.get(name, {}).get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys[name][token]
+
+    def pop(self, name, hm_token=None):
+        '''Removes and returns the keys of name (with hm_token)'''
+        with self._lock:
+            tokens = self._keys.get(name, {})
+            if hm_token:
+                return tokens.pop(str(hm_token), set())
+            self._keys.pop(name, None)
+            return set().union(*tokens.values())
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+class MemoryCache(CacheBackend):
+    '''Stores entries in dicts of this process. The default backend.
+    Thread-safe: keys are spread over stripes, each a dict with its own
+    lock, so threads working on different keys rarely wait on each other.'''
+
+    def __init__(self, stripes=16):
+        '''
+        Args:
+            Optional:
+            int stripes: number of independently locked dicts
+        '''
+        self._stripes = [({}, threading.Lock()) for _ in range(stripes)]
+        self._index = _KeyIndex()
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key, default=MISSING):
+        entries, lock = self._stripe(key)
+        with lock:
+            entry = entries.get(key)
+            if entry is None:
+                return default
+            if time.time() < entry[1]:
+                return entry[0]
+            del entries[key]
+            # under the stripe lock, lest a concurrent set's add be undone
+            self._index.discard(key)
+        return default
+
+    def set(self, key, value, ttl):
+        entries, lock = self._stripe(key)
+        with lock:
+            entries[key] = (value, time.time() + ttl)
+            self._index.add(key)
+
+    def delete(self, key):
+        entries, lock = self._stripe(key)
+        with lock:
+            entries.pop(key, None)
+            self._index.discard(key)
+
+    def delete_method(self, name, hm_token=None):
+        for key in self._index.pop(name, hm_token):
+            entries, lock = self._stripe(key)
+            with lock:
+                entries.pop(key, None)
+
+    def keys(self):
+        keys = []
+        for entries, lock in self._stripes:
+            with lock:
+                keys.extend(entries)
+        return keys
+
+    def clear(self):
+        for entries, lock in self._stripes:
+            with lock:
+                entries.clear()
+        self._index.clear()
+
+    def __len__(self):
+        return sum(len(entries) for entries, _ in self._stripes)
+
+
+class RedisCache(CacheBackend):
+    '''Stores entries in a Redis (or Redis-protocol) server, so every
+    process using it shares one cache. Multi-gets are a single MGET and
+    multi-sets a single pipelined round trip. Requires redis-py unless a
+    client is passed.'''
+
+    def __init__(self, client=None, url='redis://localhost:6379/0',
+                 prefix='hypem:'):
+        '''
+        Args:
+            Optional:
+            client: a redis.Redis instance, or anything with its get, mget,
+                set, delete, smembers, scan_iter and pipeline methods
+                (requires Redis 7 for PEXPIRE NX/GT)
+            string url: url of the server, used when client is not passed
+            string prefix: prefix of every key written to the server
+        '''
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self._client = client
+        self._prefix = prefix
+
+    def _encode_key(self, key):
+        return self._prefix + json.dumps(key, separators=(',', ':'))
+
+    def _decode_key(self, raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        name, path, params = json.loads(raw[len(self._prefix):])
+        return (name, path, tuple(tuple(param) for param in params))
+
+    @staticmethod
+    def _expiry(ttl):
+        '''Returns the px argument of SET for ttl'''
+        if ttl == float('inf'):
+            return None
+        return max(int(ttl * 1000), 1)
+
+    def get(self, key, default=MISSING):
+        raw = self._client.get(self._encode_key(key))
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl):
+        pipeline = self._client.pipeline(transaction=False)
+        self._set(pipeline, key, value, ttl)
+        pipeline.execute()
+
+    def _set(self, pipeline, key, value, ttl):
+        '''Queues storing key, and adding it to the index sets of its
+        method and token. Sets of expiring keys live as long as their
+        longest entry; non-expiring keys go in separate sets that never
+        expire, as PEXPIRE NX would put an expiry back on a persisted set'''
+        px = self._expiry(ttl)
+        raw_key = self._encode_key(key)
+        pipeline.set(raw_key, json.dumps(value, default=list), px=px)
+        name, token = _KeyIndex._bucket(key)
+        if name is None:
+            return
+        method, bucket = self._index_names(name, token, px is None)
+        pipeline.sadd(bucket, raw_key)
+        pipeline.sadd(method, bucket)
+        if px is not None:
+            for index in (bucket, method):
+                pipeline.pexpire(index, px, nx=True)
+                pipeline.pexpire(index, px, gt=True)
+
+    def _index_names(self, name, token=None, permanent=False):
+        '''Returns the names of the sets of the buckets of method name and
+        of its keys requested with token, of non-expiring keys if
+        permanent'''
+        index = self._prefix + ('idx:perm:' if permanent else 'idx:')
+        return (index + json.dumps([name]),
+                index + json.dumps([name, token]))
+
+    def delete(self, key):
+        self._client.delete(self._encode_key(key))
+
+    def delete_method(self, name, hm_token=None):
+        buckets = []
+        for permanent in (False, True):
+            method, bucket = self._index_names(name, str(hm_token), permanent)
+            buckets.extend([bucket] if hm_token else
+                           list(self._client.smembers(method)) + [method])
+        names = list(buckets)
+        for bucket in buckets:
+            names.extend(self._client.smembers(bucket))
+        self._client.delete(*names)
+
+    def keys(self):
+        index = (self._prefix + 'idx:').encode('utf-8')
+        return [self._decode_key(raw) for raw in
+                self._client.scan_iter(match=self._prefix + '*')
+                if not (raw if isinstance(raw, bytes)
+                        else raw.encode('utf-8')).startswith(index)]
+
+    def get_many(self, keys, default=MISSING):
+        keys = list(keys)
+        if not keys:
+            return []
+        raws = self._client.mget([self._encode_key(key) for key in keys])
+        return [default if raw is None else json.loads(raw) for raw in raws]
+
+    def set_many(self, items, ttl):
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in items.items():
+            self._set(pipeline, key, value, ttl)
+        pipeline.execute()
+
+
+def _serializer(name):
+    '''Returns (dumps, loads) between values and bytes for a serializer
+    name: 'json' or 'msgpack' (requires msgpack)'''
+    if name == 'json':
+        return (lambda value: json.dumps(value, separators=(',', ':'),
+                                         default=list).encode(),
+                lambda raw: json.loads(raw.decode('utf-8')))
+    if name == 'msgpack':
+        import msgpack
+        return (lambda value: msgpack.packb(value, default=list),
+                lambda raw: msgpack.unpackb(raw, raw=False))
+    raise ValueError('Unknown serializer: ' + str(name))
+
+
+def _codec(name, level):
+    '''Returns (compress, decompress) for a codec name: 'zlib', 'zstd'
+    (requires zstandard) or None'''
+    if name is None:
+        return (bytes, bytes)
+    if name == 'zlib':
+        return (lambda raw: zlib.compress(raw, level), zlib.decompress)
+    if name == 'zstd':
+        import zstandard
+        return (zstandard.ZstdCompressor(level=level).compress,
+                zstandard.ZstdDecompressor().decompress)
+    raise ValueError('Unknown codec: ' + str(name))
+
+
+class CompressedCache(CacheBackend):
+    '''Stores entries in this process as compressed serialized bytes, which
+    for big results like list_blogs(hydrate=1) take a fraction of the
+    memory of decoded objects. Entries are decoded on every hit. The least
+    recently used entries are evicted to keep the total size of stored
+    bytes within a budget.'''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, codec='zlib', level=6,
+                 serializer='json'):
+        '''
+        Args:
+            Optional:
+            int max_bytes: budget for the total size of stored entries
+            string codec: 'zlib', 'zstd' (requires zstandard) or None
+            int level: compression level of the codec
+            string serializer: 'json' or 'msgpack' (requires msgpack)
+        '''
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._dumps, self._loads = _serializer(serializer)
+        self._compress, self._decompress = _codec(codec, level)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._index = _KeyIndex()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if time.time() >= entry[1]:
+                self._pop(key)
+                return default
+            self._entries.move_to_end(key)
+        return self._loads(self._decompress(entry[0]))
+
+    def set(self, key, value, ttl):
+        raw = self._compress(self._dumps(value))
+        if len(raw) > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (raw, time.time() + ttl)
+            self._index.add(key)
+            self.nbytes += len(raw)
+            while self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def delete_method(self, name, hm_token=None):
+        with self._lock:
+            for key in self._index.pop(name, hm_token):
+                self._pop(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[0])
+            self._index.discard(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RoutingCache(CacheBackend):
+    '''Sends each endpoint's entries to its own backend, eg to compress
+    only big listings: RoutingCache({'list_blogs': CompressedCache(),
+    'latest': CompressedCache()})'''
+
+    def __init__(self, routes, default=None):
+        '''
+        Args:
+            dict routes: backend for each method name, eg
+                {'list_blogs': CompressedCache()}
+            Optional:
+            CacheBackend default: backend of all other methods (defaults to
+                a MemoryCache)
+        '''
+        from HypeM import HypeM
+        # key the routes by the names memo keys use, resolving aliases
+        self._routes = {getattr(HypeM, name).__name__: backend
+                        for name, backend in routes.items()}
+        self._default = default if default is not None else MemoryCache()
+
+    def _backend(self, key):
+        return self._routes.get(key[0], self._default)
+
+    def _backends(self):
+        backends = [self._default]
+        for backend in self._routes.values():
+            if all(backend is not seen for seen in backends):
+                backends.append(backend)
+        return backends
+
+    def get(self, key, default=MISSING):
+        return self._backend(key).get(key, default)
+
+    def set(self, key, value, ttl):
+        self._backend(key).set(key, value, ttl)
+
+    def delete(self, key):
+        self._backend(key).delete(key)
+
+    def delete_method(self, name, hm_token=None):
+        self._routes.get(name, self._default).delete_method(name, hm_token)
+
+    def keys(self):
+        return [key for backend in self._backends() for key in backend.keys()
+                if self._backend(key) is backend]
+
+
+class Track(dict):
+    '''The fields of a track shared by every response that lists it'''
+    __slots__ = ('__weakref__',)
+
+
+class Listing(dict):
+    '''A track as one response lists it: the fields particular to the
+    listing (its post, blog, rank...) over the shared Track record, which
+    is its track attribute. Reads as a dict of both; writes go to the
+    listing's own fields. Copies and pickles are plain dicts.'''
+    __slots__ = ('track',)
+
+    def __init__(self, track, fields=()):
+        dict.__init__(self, fields)
+        self.track = track
+
+    def __getitem__(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.track[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.track
+
+    def __iter__(self):
+        for key in self.track:
+            if not dict.__contains__(self, key):
+                yield key
+        for key in dict.__iter__(self):
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __reduce__(self):
+        return (dict, (self.copy(),))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def copy(self):
+        return {key: self[key] for key in self}
+
+
+class TrackIdentityMap(object):
+    '''Flyweight of the track records of GET responses: the fields intrinsic
+    to a track (shared_fields: artist, title, counts, thumbnails, tags...)
+    are merged into one shared Track per itemid, so that overlapping
+    listings (latest, popular, blog and tag tracks, favorites, item...)
+    reference a single record instead of a copy each. Fields of the most
+    recent response win; fields it lacks are kept. The fields particular to
+    a listing (post, blog, rank, ts_loved_me...) stay on a Listing per
+    response, over the shared record. Records are held weakly, for as long
+    as some cached response holds them.
+
+    Records are kept apart per hm_token the responses were requested with;
+    responses without a token share records with each other only.
+
+    Only in-process backends (MemoryCache, the default) keep the sharing:
+    serializing backends store a copy per entry regardless.'''
+
+    # fields of a track that are the same whichever response lists it
+    shared_fields = frozenset(['itemid', 'artist', 'title', 'time',
+                               'loved_count', 'posted_count', 'thumb_url',
+                               'thumb_url_medium', 'thumb_url_large',
+                               'thumb_url_artist', 'itunes_link', 'tags'])
+
+    def __init__(self):
+        self._records = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def intern(self, result, hm_token=''):
+        '''Replaces the track dicts of a decoded response (a list of tracks,
+        a single track, or a dict of them keyed by position) with Listings
+        over the shared records of hm_token, updating those with the new
+        fields. Returns result.'''
+        if isinstance(result, list):
+            for i, entry in enumerate(result):
+                result[i] = self._track(entry, hm_token)
+        elif isinstance(result, dict):
+            if 'itemid' in result:
+                return self._track(result, hm_token)
+            for k, entry in result.items():
+                result[k] = self._track(entry, hm_token)
+        return result
+
+    def _track(self, entry, hm_token):
+        if not isinstance(entry, dict) or 'itemid' not in entry:
+            return entry
+        key = (hm_token or '', entry['itemid'])
+        shared, own = {}, {}
+        for field, value in entry.items():
+            (shared if field in self.shared_fields else own)[field] = value
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                record = self._records[key] = Track(shared)
+            else:
+                record.update(shared)
+        return Listing(record, own)
+
+    def get(self, itemid, hm_token='', default=None):
+        '''Returns the shared Track of itemid for hm_token, if any response
+        holds it'''
+        return self._records.get((hm_token or '', itemid), default)
+
+    def __len__(self):
+        return len(self._records)
@@ -0,0 +1,493 @@
+'''Bulk data collection and indexing built on the HypeM client'''
+import bisect
+import heapq
+import json
+import re
+import sys
+import threading
+import time
+import warnings
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def _pages(method, page_size, *args, **kwargs):
+    '''Yields the items of every page of a paginated method, stopping at the
+    first page shorter than page_size'''
+    page = 1
+    while True:
+        items = method(*args, page=page, count=page_size, **kwargs)
+        for item in items:
+            yield item
+        if len(items) < page_size:
+            return
+        page += 1
+
+
+def _csr(n, sources, targets):
+    '''Returns (indptr, indices) arrays of the compressed sparse rows of n
+    rows, from the parallel arrays of edges sources -> targets'''
+    indptr = array('I', [0]) * (n + 1)
+    for source in sources:
+        indptr[source + 1] += 1
+    for i in range(n):
+        indptr[i + 1] += indptr[i]
+    indices = array('I', [0]) * len(sources)
+    position = array('I', indptr)
+    for source, target in zip(sources, targets):
+        indices[position[source]] = target
+        position[source] += 1
+    return indptr, indices
+
+
+class FriendCrawler(object):
+    '''Breadth-first crawler of the friend graph, from seed users outwards.
+    Each level is fetched concurrently. Usernames are interned and given
+    integer ids, and edges are kept as two arrays of ids, so that millions
+    of edges stay compact; they can also be streamed to a file as they are
+    found. Friend pages go through the memo like any call, so for big
+    crawls consider cache_policy={'get_user_friends': 0}.'''
+
+    def __init__(self, hm, workers=8, max_depth=2, page_size=100,
+                 expand=(), edge_file=None):
+        '''
+        Args:
+            HypeM hm: client to crawl with
+            Optional:
+            int workers: max number of concurrent users being fetched
+            int max_depth: levels to crawl past the seeds (1 for the seeds'
+                friends only)
+            int page_size: friends requested per page
+            tuple expand: extra data to fetch for each visited user:
+                'user' (get_user) and/or 'tracks' (get_user_tracks), stored
+                in self.profiles and self.favorites
+            file edge_file: writable text file; each edge is written to it
+                as a 'username\\tfriend\\n' line as soon as it is found
+        '''
+        self._hm = hm
+        self._workers = workers
+        self._max_depth = max_depth
+        self._page_size = page_size
+        self._expand = expand
+        self._edge_file = edge_file
+        self.ids = {}  # username: id
+        self.names = []  # id: username
+        self.sources = array('I')
+        self.targets = array('I')
+        self.profiles = {}
+        self.favorites = {}
+        self.errors = {}  # username: exception raised while fetching it
+        self._visited = set()  # ids of users fetched by any crawl
+
+    def _id(self, username):
+        username = sys.intern(str(username))
+        id_ = self.ids.get(username)
+        if id_ is None:
+            id_ = self.ids[username] = len(self.names)
+            self.names.append(username)
+        return id_
+
+    def _fetch(self, username, me):
+        '''Returns the usernames of username's friends, after fetching its
+        expansions'''
+        if 'user' in self._expand:
+            self.profiles[username] = self._hm.get_user(username)
+        if 'tracks' in self._expand:
+            self.favorites[username] = list(_pages(
+                self._hm.get_user_tracks, self._page_size, username))
+        if username == me:
+            friends = _pages(self._hm.friends_me, self._page_size)
+        else:
+            friends = _pages(self._hm.get_user_friends, self._page_size,
+                             username)
+        return [friend['username'] for friend in friends]
+
+    def crawl(self, seeds, me=None):
+        '''Crawls from the seed usernames. May be called again with new
+        seeds; users already visited are not fetched again.
+
+        Args:
+            list seeds: usernames to start from
+            Optional:
+            string me: username of the client's authenticated account,
+                whose friends are fetched with friends_me
+
+        Returns the number of users visited by this call.
+        '''
+        frontier = [id_ for id_ in dict.fromkeys(self._id(seed)
+                                                 for seed in seeds)
+                    if id_ not in self._visited]
+        queued = set(frontier)
+        count = 0
+        with ThreadPoolExecutor(self._workers) as executor:
+            for depth in range(self._max_depth):
+                if not frontier:
+                    break
+                self._visited.update(frontier)
+                futures = {executor.submit(self._fetch, self.names[id_],
+                                           me): id_
+                           for id_ in frontier}
+                frontier = []
+                for future in as_completed(futures):
+                    source = futures[future]
+                    count += 1
+                    try:
+                        friends = future.result()
+                    except Exception as e:
+                        self.errors[self.names[source]] = e
+                        continue
+                    for friend in friends:
+                        target = self._id(friend)
+                        self._add_edge(source, target)
+                        if (target not in self._visited and
+                                target not in queued):
+                            queued.add(target)
+                            frontier.append(target)
+        return count
+
+    def _add_edge(self, source, target):
+        self.sources.append(source)
+        self.targets.append(target)
+        if self._edge_file is not None:
+            self._edge_file.write(self.names[source] + '\t' +
+                                  self.names[target] + '\n')
+
+    def csr(self):
+        '''Returns the graph in compressed sparse row form: (indptr,
+        indices), arrays where the friends of user id i are
+        indices[indptr[i]:indptr[i + 1]]'''
+        return _csr(len(self.names), self.sources, self.targets)
+
+
+class BlogTrackIndex(object):
+    '''Bipartite index of which blogs posted which tracks. Tracks and
+    blogs are given integer ids and the edges are kept as compressed sparse
+    rows in both directions, so blogs_for and tracks_for take time
+    proportional to the answer. Build it from item_blogs with build().'''
+
+    def __init__(self, itemids=(), siteids=(), edges=()):
+        '''
+        Args:
+            Optional:
+            list itemids: track ids
+            list siteids: blog ids
+            iterable edges: (track index, blog index) pairs, indexing into
+                itemids and siteids
+        '''
+        self.itemids = list(itemids)
+        self.siteids = list(siteids)
+        self._tracks = array('I')
+        self._blogs = array('I')
+        self.errors = {}  # itemid: exception raised while fetching it
+        for track, blog in edges:
+            self._tracks.append(track)
+            self._blogs.append(blog)
+        self._compile()
+
+    def _compile(self):
+        self._item_index = {itemid: i for i, itemid in enumerate(self.itemids)}
+        self._site_index = {siteid: i for i, siteid in enumerate(self.siteids)}
+        self._track_ptr, self._track_blogs = _csr(
+            len(self.itemids), self._tracks, self._blogs)
+        self._blog_ptr, self._blog_tracks = _csr(
+            len(self.siteids), self._blogs, self._tracks)
+
+    @classmethod
+    def build(cls, hm, itemids, workers=16):
+        '''Fetches item_blogs for every itemid concurrently and indexes the
+        result. Tracks whose fetch failed are in the index's errors dict.
+        item_blogs results go through the memo like any call, so for big
+        builds consider cache_policy={'item_blogs': 0}.
+
+        Args:
+            HypeM hm: client to fetch with
+            iterable itemids: ids of the tracks to index
+            Optional:
+            int workers: max number of concurrent requests
+        '''
+        index = cls()
+        index.update(hm, itemids, workers)
+        return index
+
+    def update(self, hm, itemids, workers=16):
+        '''Fetches item_blogs for itemids not indexed yet and adds them'''
+        itemids = [sys.intern(itemid) for itemid in
+                   dict.fromkeys(str(itemid) for itemid in itemids)
+                   if itemid not in self._item_index]
+        with ThreadPoolExecutor(workers) as executor:
+            futures = {executor.submit(hm.item_blogs, itemid): itemid
+                       for itemid in itemids}
+            for future in as_completed(futures):
+                itemid = futures[future]
+                try:
+                    blogs = future.result()
+                except Exception as e:
+                    self.errors[itemid] = e
+                    continue
+                track = self._item_index[itemid] = len(self.itemids)
+                self.itemids.append(itemid)
+                for blog in blogs:
+                    siteid = blog['siteid']
+                    if siteid not in self._site_index:
+                        self._site_index[siteid] = len(self.siteids)
+                        self.siteids.append(siteid)
+                    self._tracks.append(track)
+                    self._blogs.append(self._site_index[siteid])
+        self._compile()
+
+    def blogs_for(self, itemid):
+        '''Returns the siteids of the blogs that posted the track itemid'''
+        i = self._item_index.get(str(itemid))
+        if i is None:
+            return []
+        return [self.siteids[blog] for blog in
+                self._track_blogs[self._track_ptr[i]:self._track_ptr[i + 1]]]
+
+    def tracks_for(self, siteid):
+        '''Returns the itemids of the indexed tracks the blog siteid
+        posted'''
+        i = self._site_index.get(siteid)
+        if i is None:
+            return []
+        return [self.itemids[track] for track in
+                self._blog_tracks[self._blog_ptr[i]:self._blog_ptr[i + 1]]]
+
+    def save(self, path):
+        '''Writes the index to path: a JSON header line with the ids,
+        followed by the edge arrays as raw bytes'''
+        header = {'itemids': self.itemids, 'siteids': self.siteids,
+                  'edges': len(self._tracks),
+                  'itemsize': self._tracks.itemsize,
+                  'byteorder': sys.byteorder}
+        with open(path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            self._tracks.tofile(f)
+            self._blogs.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        '''Reads an index written by save()'''
+        index = cls()
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            assert header['itemsize'] == index._tracks.itemsize, (
+                'Index was saved with a different array item size')
+            index.itemids = [sys.intern(itemid)
+                             for itemid in header['itemids']]
+            index.siteids = header['siteids']
+            index._tracks.fromfile(f, header['edges'])
+            index._blogs.fromfile(f, header['edges'])
+        if header['byteorder'] != sys.byteorder:
+            index._tracks.byteswap()
+            index._blogs.byteswap()
+        index._compile()
+        return index
+
+
+_WORD = re.compile(r'\w+')
+
+
+def _words(text):
+    '''Returns the lowercase words of text'''
+    return _WORD.findall(str(text).lower())
+
+
+class TrackSearchIndex(object):
+    '''In-memory inverted index of tracks by the words of their artist,
+    title and tags, answering prefix queries without a round trip. Add the
+    tracks of any endpoint's results as they are fetched; a track added
+    again is re-indexed with its new fields.'''
+
+    fields = ('artist', 'title', 'tags')
+
+    def __init__(self):
+        self.tracks = {}  # itemid: latest record
+        self._order = {}  # itemid: number of tracks added before it
+        self._postings = {}  # word: set of itemids
+        self._words = {}  # itemid: words it is indexed under
+        self._vocabulary = []  # sorted words, for prefix lookups
+        self._new_words = []  # words not yet merged into the vocabulary
+
+    def add(self, tracks):
+        '''Indexes a track record, or a list of them, eg a result of latest,
+        popular or get_blog_tracks. Records without an itemid are
+        skipped. Returns the number of tracks indexed.'''
+        if isinstance(tracks, dict):
+            tracks = [tracks]
+        count = 0
+        for track in tracks:
+            if not isinstance(track, dict) or 'itemid' not in track:
+                continue
+            itemid = track['itemid']
+            words = set()
+            for field in self.fields:
+                value = track.get(field) or ''
+                if isinstance(value, (list, tuple)):
+                    value = ' '.join(str(v) for v in value)
+                words.update(_words(value))
+            for word in self._words.get(itemid, set()) - words:
+                self._postings[word].discard(itemid)
+            for word in words:
+                if word not in self._postings:
+                    self._postings[word] = set()
+                    self._new_words.append(word)
+                self._postings[word].add(itemid)
+            self._words[itemid] = words
+            self._order.setdefault(itemid, len(self._order))
+            self.tracks[itemid] = track
+            count += 1
+        return count
+
+    def _matches(self, prefix):
+        '''Returns the set of itemids indexed under a word with prefix'''
+        if self._new_words:
+            self._vocabulary = sorted(self._vocabulary + self._new_words)
+            self._new_words = []
+        matches = set()
+        i = bisect.bisect_left(self._vocabulary, prefix)
+        while (i < len(self._vocabulary) and
+               self._vocabulary[i].startswith(prefix)):
+            matches |= self._postings[self._vocabulary[i]]
+            i += 1
+        return matches
+
+    def search(self, query, limit=20):
+        '''Returns up to limit track records matching every word of query,
+        each word as a prefix (eg 'rath bri' matches Rather Bright), in the
+        order the tracks were first added'''
+        words = _words(query)
+        if not words:
+            return []
+        matches = self._matches(words[0])
+        for word in words[1:]:
+            if not matches:
+                break
+            matches &= self._matches(word)
+        order = self._order
+        return [self.tracks[itemid] for itemid in
+                heapq.nsmallest(limit, matches, key=order.__getitem__)]
+
+    def lookup(self, hm, query, limit=20):
+        '''Searches the index, falling back to hm.latest(q=query) when there
+        is no local match; the fallback's tracks are added to the index.'''
+        results = self.search(query, limit)
+        if not results:
+            self.add(hm.latest(q=query))
+            results = self.search(query, limit)
+        return results
+
+
+def _entry_id(entry):
+    '''Returns the id of a chart entry: its itemid, artist or siteid'''
+    for field in ('itemid', 'artist', 'siteid', 'id'):
+        if field in entry:
+            return str(entry[field])
+    raise ValueError('Chart entry without an id: ' + repr(entry))
+
+
+class ChartRecorder(object):
+    '''Records snapshots of charts in an append-only file of JSON lines.
+    Each line only holds the ranks that changed since the chart's previous
+    snapshot: {"t": time, "c": chart, "n": length, "d": [[rank, id], ...]}.
+    Snapshots identical to the previous one are not written. Any past
+    snapshot can be rebuilt by replaying the file.'''
+
+    # chart name: (method, kwargs)
+    default_charts = {
+        'popular/now': ('popular', {'mode': 'now'}),
+        'popular/lastweek': ('popular', {'mode': 'lastweek'}),
+        'popular/noremix': ('popular', {'mode': 'noremix'}),
+        'popular/remix': ('popular', {'mode': 'remix'}),
+        'popular_artists': ('popular_artists', {}),
+        'featured': ('featured', {}),
+    }
+
+    def __init__(self, hm, path, charts=None):
+        '''
+        Args:
+            HypeM hm: client to poll with
+            string path: file to append snapshots to; existing snapshots in
+                it are loaded, so recording continues where it stopped
+            Optional:
+            dict charts: chart name: (method name, kwargs) to record,
+                defaults to default_charts
+        '''
+        self._hm = hm
+        self._path = path
+        self.charts = dict(self.default_charts if charts is None else charts)
+        self._latest = {}  # chart: list of ids in its last snapshot
+        for record in self._records():
+            self._latest[record['c']] = self._apply(
+                self._latest.get(record['c'], []), record)
+
+    def _records(self):
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+    @staticmethod
+    def _apply(ids, record):
+        ids = ids[:record['n']]
+        ids.extend([None] * (record['n'] - len(ids)))
+        for rank, id_ in record['d']:
+            ids[rank] = id_
+        return ids
+
+    def snapshot(self, ts=None):
+        '''Fetches every chart, bypassing the memo, and appends the changed
+        ones to the file. Returns the names of the charts written.'''
+        ts = int(time.time()) if ts is None else ts
+        written = []
+        lines = []
+        for chart, (method, kwargs) in self.charts.items():
+            with self._hm.refreshing():
+                ids = [_entry_id(entry) for entry in
+                       getattr(self._hm, method)(**kwargs)]
+            previous = self._latest.get(chart)
+            if previous == ids:
+                continue
+            previous = previous or []
+            changes = [[rank, id_] for rank, id_ in enumerate(ids)
+                       if rank >= len(previous) or previous[rank] != id_]
+            lines.append(json.dumps({'t': ts, 'c': chart, 'n': len(ids),
+                                     'd': changes}, separators=(',', ':')))
+            self._latest[chart] = ids
+            written.append(chart)
+        if lines:
+            with open(self._path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        return written
+
+    def run(self, interval, stop=None):
+        '''Takes a snapshot every interval seconds until the threading.Event
+        stop is set (or forever). Failed snapshots are retried at the next
+        interval.'''
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                self.snapshot()
+            except Exception as e:
+                warnings.warn('Chart snapshot failed: ' + repr(e),
+                              RuntimeWarning)
+            stop.wait(interval)
+
+    def rebuild(self, chart, at=None):
+        '''Returns the ids of chart, in rank order, as of its last snapshot
+        taken at or before the time at (defaults to the latest snapshot).
+        Returns None if there is no such snapshot.'''
+        ids = None
+        for record in self._records():
+            if record['c'] != chart:
+                continue
+            if at is not None and record['t'] > at:
+                break
+            ids = self._apply(ids or [], record)
+        return ids
+
+    def times(self, chart):
+        '''Returns the times of the snapshots written for chart'''
+        return [record['t'] for record in self._records()
+                if record['c'] == chart]
@@ -0,0 +1,165 @@
+'''Streaming, resumable downloads of the tracks' audio'''
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Bandwidth(object):
+    '''Token bucket limiting the bytes per second shared by all threads'''
+
+    def __init__(self, bytes_per_second):
+        self._rate = float(bytes_per_second)
+        self._allowance = self._rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        '''Blocks until n more bytes may be transferred'''
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self._allowance +
+                                  (now - self._last) * self._rate,
+                                  self._rate)
+            self._last = now
+            self._allowance -= n
+            wait = -self._allowance / self._rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DownloadError(Exception):
+    '''A track could not be downloaded'''
+
+
+class Downloader(object):
+    '''Downloads tracks' audio from the URLs of get_track_stream, streaming
+    it to disk in chunks so memory use stays bounded. Transfers are written
+    to a '.part' file and resumed with an HTTP Range request after an
+    interruption, by a retry or by a later run. Stream URLs expire, so one
+    that is refused is resolved again, bypassing the memo.'''
+
+    # statuses with which hosts refuse an expired stream url
+    expired_statuses = (401, 403, 404, 410)
+
+    def __init__(self, hm, directory='.', workers=4, max_bytes_per_sec=None,
+                 chunk_size=64 * 1024, progress=None, retries=3):
+        '''
+        Args:
+            HypeM hm: client to resolve and download with
+            Optional:
+            string directory: where tracks are saved as <track_id>.mp3
+            int workers: max number of concurrent downloads
+            number max_bytes_per_sec: bandwidth cap shared by all downloads
+            int chunk_size: bytes read and written at a time
+            callable progress: called with (track_id, bytes downloaded,
+                total bytes or None) after every chunk
+            int retries: attempts after the first for each track
+        '''
+        self._hm = hm
+        self._directory = directory
+        self._workers = workers
+        self._bandwidth = (_Bandwidth(max_bytes_per_sec)
+                           if max_bytes_per_sec else None)
+        self._chunk_size = chunk_size
+        self._progress = progress
+        self._retries = retries
+
+    def path(self, track_id):
+        '''Returns the path a track is saved to'''
+        return os.path.join(self._directory, str(track_id) + '.mp3')
+
+    def download(self, track_id):
+        '''Downloads a track, resuming a previous partial download. Returns
+        the path of the file. Raises DownloadError if the track has no
+        stream or every attempt failed.'''
+        path = self.path(track_id)
+        if os.path.exists(path):
+            return path
+        url = self._hm.get_track_stream(track_id)
+        error = None
+        for attempt in range(self._retries + 1):
+            if not url:
+                raise DownloadError('No stream available for ' +
+                                    str(track_id))
+            try:
+                if self._transfer(track_id, url, path):
+                    return path
+                # the url was refused: resolve a new one
+                with self._hm.refreshing():
+                    url = self._hm.get_track_stream(track_id)
+            except (IOError, ValueError) as e:
+                error = e
+            else:
+                error = None
+        if error is None:
+            raise DownloadError('Failed to download {}: its stream url kept '
+                                'being refused'.format(track_id))
+        raise DownloadError('Failed to download {}: {!r}'.format(track_id,
+                                                                 error))
+
+    def download_many(self, track_ids):
+        '''Downloads tracks concurrently. Returns a dict of track_id: path,
+        or the exception raised for tracks that failed.'''
+        results = {}
+        with ThreadPoolExecutor(self._workers) as executor:
+            futures = {track_id: executor.submit(self.download, track_id)
+                       for track_id in track_ids}
+            for track_id, future in futures.items():
+                try:
+                    results[track_id] = future.result()
+                except Exception as e:
+                    results[track_id] = e
+        return results
+
+    def _transfer(self, track_id, url, path):
+        '''Streams url into path's part file, from where it stopped.
+        Returns False if the url was refused as expired, True when the file
+        is complete.'''
+        part = path + '.part'
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        response = self._hm.transport.request('GET', url, headers=headers,
+                                              stream=True)
+        try:
+            status = response.status_code
+            if status in self.expired_statuses:
+                return False
+            if status == 416:
+                # nothing left past offset: the part file is complete
+                os.replace(part, path)
+                return True
+            if status not in (200, 206):
+                raise ValueError('Status code unhandled: {} for URL {}'
+                                 .format(status, url))
+            if status == 200:
+                # the host ignored the range: start over
+                offset = 0
+            total = self._total(response, offset)
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(self._chunk_size):
+                    if self._bandwidth:
+                        self._bandwidth.consume(len(chunk))
+                    f.write(chunk)
+                    offset += len(chunk)
+                    if self._progress:
+                        self._progress(track_id, offset, total)
+        finally:
+            response.close()
+        if total is not None and offset < total:
+            raise IOError('Transfer of {} interrupted at {} of {} bytes'
+                          .format(track_id, offset, total))
+        os.replace(part, path)
+        return True
+
+    @staticmethod
+    def _total(response, offset):
+        '''Returns the full size of the file from the response's headers,
+        or None if unknown'''
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+        if match:
+            return int(match.group(1))
+        length = response.headers.get('Content-Length')
+        return offset + int(length) if length else None
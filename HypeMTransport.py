@@ -0,0 +1,402 @@
+'''HTTP transports the HypeM client performs its requests with'''
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import timedelta
+from http.cookiejar import CookieJar
+from urllib.parse import urlencode, urljoin
+from urllib.request import Request
+
+
+class TransportError(IOError):
+    '''A request failed in the underlying HTTP library'''
+
+
+class Transport(object):
+    '''Interface of HypeM transports. request returns a response object with
+    requests' status_code, text, content, url and headers attributes and
+    its iter_content and close methods. Network failures, while requesting
+    or reading the body, raise an IOError, as requests' errors are.'''
+
+    def request(self, method, url, data=None, headers=None, stream=False):
+        '''Performs a request.
+
+        Args:
+            string method: 'GET', 'POST', 'PUT' or 'DELETE'
+            string url: the full url
+            Optional:
+            dict data: form fields of the body
+            dict headers: request headers
+            bool stream: if true, the body is not read until iter_content,
+                and the response must be closed
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''Releases the transport's connections'''
+        pass
+
+
+class RequestsTransport(Transport):
+    '''HTTP/1.1 through a requests.Session. The default transport.'''
+
+    def __init__(self, session=None, pool_maxsize=None, per_thread=False):
+        '''
+        Args:
+            Optional:
+            requests.Session session: session to use (defaults to a new one)
+            int pool_maxsize: max connections kept per host (requests'
+                default is 10)
+            bool per_thread: send from a session per thread, as requests
+                does not guarantee a Session is thread-safe. Each copies
+                session's headers, auth, proxies and TLS settings and shares
+                its adapters, and so its connection pools, which are.
+        '''
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+        self._local = threading.local() if per_thread else None
+        if pool_maxsize is not None:
+            self.set_pool_size(pool_maxsize)
+
+    def set_pool_size(self, pool_maxsize):
+        '''Keeps up to pool_maxsize connections per host'''
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _thread_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+            for attribute in ('auth', 'proxies', 'verify', 'cert',
+                              'max_redirects', 'trust_env'):
+                setattr(session, attribute,
+                        getattr(self.session, attribute))
+            session.headers = self.session.headers.copy()
+            # mounted on self.session, later mounts included
+            session.adapters = self.session.adapters
+        return session
+
+    def request(self, method, url, data=None, headers=None, stream=False):
+        session = self.session
+        if self._local is not None:
+            session = self._thread_session()
+        return session.request(method, url, data=data, headers=headers,
+                               stream=stream)
+
+    def close(self):
+        self.session.close()
+
+
+class _Response(object):
+    '''Adapts another library's response to the requests-like interface'''
+
+    def __init__(self, status_code, url, headers, elapsed, read, iterate,
+                 release, errors=()):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.elapsed = timedelta(seconds=elapsed)
+        self._read = read
+        self._iterate = iterate
+        self._release = release
+        # the library's exceptions, raised as TransportError
+        self._errors = errors
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            try:
+                self._content = self._read()
+            except self._errors as e:
+                raise TransportError(e) from e
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def iter_content(self, chunk_size=1):
+        if self._content is not None:
+            for i in range(0, len(self._content), chunk_size):
+                yield self._content[i:i + chunk_size]
+            return
+        try:
+            for chunk in self._iterate(chunk_size):
+                yield chunk
+        except self._errors as e:
+            raise TransportError(e) from e
+
+    def close(self):
+        self._release()
+
+
+class _CookieMessage(object):
+    '''Adapts a urllib3 response to what CookieJar.extract_cookies reads'''
+
+    def __init__(self, headers):
+        self._headers = headers
+
+    def info(self):
+        return self
+
+    def get_all(self, name, default=None):
+        return self._headers.getlist(name) or default
+
+
+class Urllib3Transport(Transport):
+    '''HTTP/1.1 through a urllib3.PoolManager, skipping requests' overhead
+    on top of the same connection pools. Cookies are kept in a CookieJar,
+    as in a requests session, since scraping needs the track page's cookies
+    for the stream request that follows. Redirects are followed, as requests
+    does.'''
+
+    def __init__(self, maxsize=10, retries=None, timeout=None):
+        '''
+        Args:
+            Optional:
+            int maxsize: max connections kept per host
+            retries: urllib3 retries setting (defaults to following up to
+                30 redirects, as requests does, and never retrying)
+            timeout: urllib3 timeout setting
+        '''
+        import urllib3
+        if retries is None:
+            retries = urllib3.Retry(total=None, connect=0, read=0, status=0,
+                                    other=0, redirect=30)
+        self._pool = urllib3.PoolManager(maxsize=maxsize, retries=retries,
+                                         timeout=timeout)
+        self._errors = (urllib3.exceptions.HTTPError,)
+        self.cookies = CookieJar()
+
+    def request(self, method, url, data=None, headers=None, stream=False):
+        headers = dict(headers or {})
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        cookie_request = Request(url, method=method)
+        self.cookies.add_cookie_header(cookie_request)
+        cookie = cookie_request.get_header('Cookie')
+        if cookie:
+            headers['Cookie'] = cookie
+        start = time.perf_counter()
+        try:
+            response = self._pool.request(method, url, body=body,
+                                          headers=headers,
+                                          preload_content=not stream)
+        except self._errors as e:
+            raise TransportError(e) from e
+        url = urljoin(url, response.geturl() or url)
+        self.cookies.extract_cookies(_CookieMessage(response.headers),
+                                     Request(url, method=method))
+        return _Response(response.status, url, response.headers,
+                         time.perf_counter() - start,
+                         lambda: response.data, response.stream,
+                         response.release_conn, self._errors)
+
+    def close(self):
+        self._pool.clear()
+
+
+class HttpxTransport(Transport):
+    '''HTTP/2 (or HTTP/1.1) through an httpx.Client. Over HTTP/2 many
+    concurrent requests share a few multiplexed connections to each host.
+    Requires httpx, and h2 for HTTP/2.'''
+
+    def __init__(self, http2=True, max_connections=10, timeout=30):
+        '''
+        Args:
+            Optional:
+            bool http2: negotiate HTTP/2 with hosts that support it
+            int max_connections: max connections kept open in total
+            number timeout: seconds before a request times out
+        '''
+        import httpx
+        self._client = httpx.Client(
+            http2=http2, timeout=timeout, follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections))
+        self._errors = (httpx.HTTPError,)
+
+    def request(self, method, url, data=None, headers=None, stream=False):
+        request = self._client.build_request(method, url, data=data,
+                                             headers=headers)
+        start = time.perf_counter()
+        try:
+            response = self._client.send(request, stream=stream)
+        except self._errors as e:
+            raise TransportError(e) from e
+        return _Response(response.status_code, str(response.url),
+                         response.headers, time.perf_counter() - start,
+                         response.read, response.iter_bytes, response.close,
+                         self._errors)
+
+    def close(self):
+        self._client.close()
+
+
+class CassetteMiss(Exception):
+    '''A replayed cassette has no recording of a request'''
+
+
+_MAGIC = b'HMCASS1\n'
+_LENGTH = struct.Struct('>I')
+_ENTRY = struct.Struct('>QIQ')  # request hash, occurrence, record offset
+
+
+def _request_hash(method, url, data):
+    '''Returns the identity of a request: its 64 bit hash and its text'''
+    identity = method.upper() + ' ' + url
+    if data:
+        identity += ' ' + urlencode(sorted((str(k), str(v))
+                                           for k, v in data.items()))
+    digest = hashlib.blake2b(identity.encode('utf-8'), digest_size=8)
+    return int.from_bytes(digest.digest(), 'big'), identity
+
+
+class CassetteTransport(Transport):
+    '''Records the exchanges of another transport to a cassette file, or
+    replays them from one with no network, eg to re-run a pipeline against
+    captured traffic.
+
+    A cassette is two files: path holds the exchanges, each a zlib
+    compressed record appended as it happens, and path + '.idx' a sorted
+    table of fixed-size (request hash, occurrence, offset) entries written
+    on close. Replay memory-maps both and binary searches the table, so
+    captures larger than memory are served without being loaded. A request
+    made several times is replayed in the order it was recorded, repeating
+    the last response once they run out.'''
+
+    def __init__(self, path, mode='replay', transport=None, latency=0):
+        '''
+        Args:
+            string path: cassette file
+            Optional:
+            string mode: 'record' (overwriting path) or 'replay'
+            Transport transport: transport recorded from (defaults to a new
+                RequestsTransport)
+            latency: seconds each replayed response is delayed by, or
+                'recorded' for the time the recorded request took
+        '''
+        if mode not in ('record', 'replay'):
+            raise ValueError('Unknown cassette mode: ' + str(mode))
+        self.path = path
+        self.mode = mode
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._seen = {}  # request hash -> occurrences so far
+        if mode == 'record':
+            self._transport = transport or RequestsTransport()
+            self._file = open(path, 'wb')
+            self._file.write(_MAGIC)
+            self._entries = []
+        else:
+            with open(path, 'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._data[:len(_MAGIC)] != _MAGIC:
+                raise ValueError(path + ' is not a cassette')
+            with open(path + '.idx', 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                # an empty file cannot be mapped
+                self._index = (mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+                               if size else b'')
+            self._count = size // _ENTRY.size
+
+    def request(self, method, url, data=None, headers=None, stream=False):
+        key, identity = _request_hash(method, url, data)
+        with self._lock:
+            occurrence = self._seen.get(key, 0)
+            self._seen[key] = occurrence + 1
+        if self.mode == 'record':
+            return self._record(key, occurrence, identity, method, url, data,
+                                headers, stream)
+        return self._replay(key, occurrence, identity)
+
+    def _record(self, key, occurrence, identity, method, url, data, headers,
+                stream):
+        response = self._transport.request(method, url, data=data,
+                                           headers=headers, stream=stream)
+        try:
+            body = response.content
+        finally:
+            if stream:
+                response.close()
+        elapsed = getattr(response, 'elapsed', None)
+        meta = {'r': identity, 's': response.status_code,
+                'u': str(response.url), 'h': dict(response.headers),
+                'e': elapsed.total_seconds() if elapsed is not None else 0}
+        record = zlib.compress(json.dumps(meta).encode('utf-8') + b'\n' +
+                               body)
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(_LENGTH.pack(len(record)) + record)
+            self._entries.append((key, occurrence, offset))
+        return response
+
+    def _find(self, key, occurrence):
+        '''Returns the offsets of the records of the request hash key, from
+        its occurrence'th recording on (or its last, if fewer)'''
+        index, low, high = self._index, 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if _ENTRY.unpack_from(index, middle * _ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        offsets = []
+        for i in range(low, self._count):
+            entry_key, _, offset = _ENTRY.unpack_from(index, i * _ENTRY.size)
+            if entry_key != key:
+                break
+            offsets.append(offset)
+        return offsets[occurrence:] + offsets[:occurrence][::-1]
+
+    def _load(self, offset):
+        length, = _LENGTH.unpack_from(self._data, offset)
+        start = offset + _LENGTH.size
+        meta, _, body = zlib.decompress(
+            self._data[start:start + length]).partition(b'\n')
+        return json.loads(meta.decode('utf-8')), body
+
+    def _replay(self, key, occurrence, identity):
+        for offset in self._find(key, occurrence):
+            meta, body = self._load(offset)
+            # the hash may collide: check the request itself
+            if meta['r'] == identity:
+                break
+        else:
+            raise CassetteMiss(identity)
+        delay = meta['e'] if self._latency == 'recorded' else self._latency
+        if delay:
+            time.sleep(delay)
+        return _Response(meta['s'], meta['u'], meta['h'], meta['e'],
+                         lambda: body, lambda size: (
+                             body[i:i + size]
+                             for i in range(0, len(body), size)),
+                         lambda: None)
+
+    def close(self):
+        if self.mode == 'record':
+            with self._lock:
+                if self._file.closed:
+                    return
+                self._file.close()
+                with open(self.path + '.idx', 'wb') as f:
+                    for entry in sorted(self._entries):
+                        f.write(_ENTRY.pack(*entry))
+            self._transport.close()
+        elif not self._data.closed:
+            self._data.close()
+            if self._count:
+                self._index.close()
@@ -0,0 +1,606 @@
+'''Background helpers built on the HypeM client'''
+import asyncio
+import atexit
+import copy
+import heapq
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+import warnings
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed, wait)
+from BaseAPI import APIError
+
+
+class ActionQueue(object):
+    '''Write-behind queue for log_user_action. Events are buffered and
+    posted by a fixed number of background worker threads, so logging never
+    waits on the network. Failed posts are retried with exponential backoff
+    and, when retries run out, appended to a dead-letter file as JSON lines.
+    Pending events are flushed on close() and at interpreter exit; events
+    logged after close() are dead-lettered.'''
+
+    def __init__(self, hm, workers=4, retries=3, backoff=0.5, maxsize=0,
+                 dead_letter='hypem_dead_letter.jsonl'):
+        '''
+        Args:
+            HypeM hm: client used to post events
+            Optional:
+            int workers: max number of concurrent posts
+            int retries: attempts after the first before an event is
+                dead-lettered
+            number backoff: seconds to wait before the first retry, doubled
+                for each further retry
+            int maxsize: max number of buffered events (0 for unbounded);
+                events logged while full are dead-lettered
+            string dead_letter: path of the dead-letter file
+        '''
+        self._hm = hm
+        self._retries = retries
+        self._backoff = backoff
+        self._dead_letter = dead_letter
+        self._dead_letter_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize)
+        self._closed = False
+        # orders putting events against putting the workers' stop sentinels
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.close)
+
+    def log(self, type, itemid, pos, hm_token=None, ts=None):
+        '''Queues a user action; takes the arguments of HypeM.log_user_action.
+        ts defaults to the time of this call, not of the post.'''
+        assert str(type) in ['listen'], '"type" must be listen'
+        event = {'type': type, 'itemid': itemid, 'pos': pos,
+                 'hm_token': self._hm._assert_hm_token(hm_token),
+                 'ts': int(time.time()) if ts is None else ts}
+        with self._lock:
+            if self._closed:
+                error = 'queue closed'
+            else:
+                try:
+                    self._queue.put_nowait(event)
+                    return
+                except queue.Full:
+                    error = 'queue full'
+        self._write_dead_letter(event, error)
+
+    def flush(self):
+        '''Blocks until every queued event has been posted or dead-lettered'''
+        self._queue.join()
+
+    def close(self):
+        '''Flushes pending events and stops the workers'''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _ in self._workers:
+                self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        atexit.unregister(self.close)
+
+    def requeue_dead_letters(self):
+        '''Queues the events of the dead-letter file again, emptying it.
+        Returns the number of events queued.'''
+        with self._dead_letter_lock:
+            try:
+                with open(self._dead_letter) as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                return 0
+            open(self._dead_letter, 'w').close()
+        for line in lines:
+            event = json.loads(line)
+            event.pop('error', None)
+            self.log(**event)
+        return len(lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _work(self):
+        while True:
+            event = self._queue.get()
+            try:
+                if event is None:
+                    return
+                self._post(event)
+            finally:
+                self._queue.task_done()
+
+    def _post(self, event):
+        for attempt in range(self._retries + 1):
+            try:
+                self._hm.log_user_action(**event)
+                return
+            except Exception as e:
+                error = e
+                if attempt < self._retries:
+                    time.sleep(self._backoff * 2 ** attempt)
+        self._write_dead_letter(event, repr(error))
+
+    def _write_dead_letter(self, event, error):
+        record = dict(event, error=error)
+        with self._dead_letter_lock:
+            with open(self._dead_letter, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+class TokenPool(object):
+    '''Fetches authenticated endpoints on behalf of many accounts through
+    one HypeM client, so every account shares its connection pool and memo.
+    Calls are spread over a fixed number of worker threads, taken round-robin
+    across accounts, and each account's token is held to its own rate limit.
+    An account whose token is rejected is logged in again with get_token, if
+    its credentials were given, and the call retried once.'''
+
+    def __init__(self, hm, workers=16, rate_limit=2.0):
+        '''
+        Args:
+            HypeM hm: client shared by all accounts
+            Optional:
+            int workers: max number of concurrent requests
+            number rate_limit: max calls per second made with any one token
+        '''
+        self._hm = hm
+        self._workers = workers
+        self._interval = 1.0 / rate_limit
+        self._accounts = {}
+        self._lock = threading.Lock()
+        set_pool_size = getattr(hm.transport, 'set_pool_size', None)
+        if set_pool_size is not None:
+            # keep a connection per worker instead of requests' default 10
+            set_pool_size(workers)
+
+    def add(self, user, hm_token=None, username=None, password=None):
+        '''Adds an account to the pool. Needs an hm_token, a username and
+        password to obtain one with, or both.
+
+        Args:
+            user: any hashable name for the account, used in results
+            Optional:
+            string hm_token: the account's token
+            string username: username to obtain a token with
+            string password: password to obtain a token with
+        '''
+        assert hm_token or (username and password), ('Must pass an hm_token '
+                                                     'or credentials')
+        self._accounts[user] = {'hm_token': hm_token, 'username': username,
+                                'password': password, 'next': 0.0}
+        if not hm_token:
+            self._login(user, None)
+
+    def tokens(self):
+        '''Returns a dict of user: current hm_token'''
+        return {user: account['hm_token']
+                for user, account in self._accounts.items()}
+
+    def fetch(self, *methods, users=None, **kwargs):
+        '''Calls each named method of the client once per account.
+
+        Args:
+            strings methods: names of methods taking an hm_token keyword
+                eg 'favorites_me', 'history_me', 'friends_me', 'feed'
+            Optional:
+            list users: accounts to fetch for (defaults to all)
+            kwargs: passed to every call, eg count=100
+
+        Returns a dict of {user: {method: result}}, where a call that failed
+        has its exception as result.
+        '''
+        users = list(self._accounts) if users is None else list(users)
+        pending = {user: list(methods) for user in users}
+        results = {user: {} for user in users}
+        # (ready time, tie breaker, user): the earliest ready account goes
+        # next, and accounts that are equally ready take turns
+        ready = [(self._accounts[user]['next'], i, user)
+                 for i, user in enumerate(users) if methods]
+        heapq.heapify(ready)
+        counter = itertools.count(len(ready))
+        condition = threading.Condition()
+
+        def work():
+            while True:
+                with condition:
+                    if not ready:
+                        return
+                    _, _, user = heapq.heappop(ready)
+                    method = pending[user].pop(0)
+                    account = self._accounts[user]
+                    # 'next' is shared with concurrent fetch() calls
+                    with self._lock:
+                        start = max(account['next'], time.monotonic())
+                        account['next'] = start + self._interval
+                    if pending[user]:
+                        heapq.heappush(ready, (account['next'],
+                                               next(counter), user))
+                delay = start - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    results[user][method] = self._call(user, method, kwargs)
+                except Exception as e:
+                    results[user][method] = e
+
+        threads = [threading.Thread(target=work, daemon=True)
+                   for _ in range(min(self._workers, len(users)) or 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _call(self, user, method, kwargs):
+        account = self._accounts[user]
+        hm_token = account['hm_token']
+        try:
+            return getattr(self._hm, method)(hm_token=hm_token, **kwargs)
+        except APIError:
+            if not (account['username'] and account['password']):
+                raise
+        return getattr(self._hm, method)(hm_token=self._login(user, hm_token),
+                                         **kwargs)
+
+    def _login(self, user, expired_token):
+        '''Obtains a new token for user, unless another thread already
+        replaced expired_token. Returns the current token.'''
+        account = self._accounts[user]
+        with self._lock:
+            if account['hm_token'] != expired_token:
+                return account['hm_token']
+            # log in through a separate client sharing the transport, since
+            # get_token overwrites its client's hm_token
+            login = type(self._hm)(payload_auth=self._hm._payload_auth,
+                                   transport=self._hm.transport)
+            account['hm_token'] = login.get_token(
+                username=account['username'], password=account['password'])
+            return account['hm_token']
+
+
+def fetch_tag_range(hm, tag, fav_from, fav_to, slices=8, workers=8,
+                    page_size=100, max_pages=5, closed_below=None):
+    '''Fetches the tracks of get_tag_tracks between fav_from and fav_to
+    (inclusive) by splitting the range into windows fetched in parallel,
+    instead of paging deeply through the whole range. A window that still
+    has full pages after max_pages is split in two and both halves fetched;
+    one of a single favorite count is paged through past max_pages.
+    Results are merged and deduplicated by itemid.
+
+    Windows entirely below closed_below are treated as closed, ie they will
+    not change any more, and are cached forever. Leave it unset unless the
+    bounds are such that past windows are final.
+
+    Args:
+        HypeM hm: client to fetch with
+        string tag: the genre tag
+        int fav_from: lower bound of the range
+        int fav_to: upper bound of the range
+        Optional:
+        int slices: number of windows the range is first split into
+        int workers: max number of concurrent requests
+        int page_size: count of each request
+        int max_pages: pages fetched per window before it is split
+        int closed_below: windows whose upper bound is below this are cached
+            forever
+
+    Returns list of tracks.
+    '''
+    def fetch(low, high):
+        '''Returns (tracks, dense) for the window [low, high]. A window of
+        a single value cannot be split, so it is paged through to the end.'''
+        closed = closed_below is not None and high < closed_below
+        tracks = []
+        for page in itertools.count(1):
+            if page > max_pages and high > low:
+                return tracks, True
+            with hm.cache_for(float('inf') if closed else None):
+                items = hm.get_tag_tracks(tag, fav_from=low, fav_to=high,
+                                          page=page, count=page_size)
+            tracks.extend(items)
+            if len(items) < page_size:
+                return tracks, False
+
+    width = max((fav_to - fav_from + 1) // slices, 1)
+    windows = [(low, min(low + width - 1, fav_to))
+               for low in range(fav_from, fav_to + 1, width)]
+    merged = {}
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(fetch, *window): window
+                   for window in windows}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                low, high = pending.pop(future)
+                tracks, dense = future.result()
+                for track in tracks:
+                    merged[track['itemid']] = track
+                if dense and high > low:
+                    middle = (low + high) // 2
+                    for window in ((low, middle), (middle + 1, high)):
+                        pending[executor.submit(fetch, *window)] = window
+    return list(merged.values())
+
+
+def scrape_tracks(hm, track_ids, fields=('tags', 'stream'), threads=16,
+                  processes=None):
+    '''Scrapes get_track_tags and/or get_track_stream of many tracks. Pages
+    are fetched by a pool of threads while their HTML is parsed by a pool
+    of processes, so parsing is not serialized under the GIL; only the
+    extracted tags and stream ids come back from the processes. Each page is
+    fetched and parsed once for all fields. Results are memoized as if the
+    methods were called one by one.
+
+    Args:
+        HypeM hm: client to fetch with
+        list track_ids: ids of the tracks
+        Optional:
+        tuple fields: 'tags' and/or 'stream'
+        int threads: max number of concurrent requests
+        int processes: number of parsing processes (defaults to the number
+            of CPUs)
+
+    Returns dict of track id to a dict of its fields, or to the exception
+    scraping it raised.
+    '''
+    methods = {'tags': 'get_track_tags', 'stream': 'get_track_stream'}
+    with ProcessPoolExecutor(processes) as parse_pool:
+        scraper = copy.copy(hm)
+        scraper.parse_pool = parse_pool
+
+        def scrape(track_id):
+            # one fetch and parse of the page serves every field
+            with scraper._sharing_pages():
+                return {field: getattr(scraper, methods[field])(track_id)
+                        for field in fields}
+
+        results = {}
+        with ThreadPoolExecutor(threads) as executor:
+            futures = {executor.submit(scrape, track_id): track_id
+                       for track_id in track_ids}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    results[futures[future]] = e
+    return results
+
+
+class FeedWatcher(object):
+    '''Watches an account's feed by polling the cheap feed_count, and only
+    fetching feed when the count rises. Polling backs off while the feed is
+    idle and returns to the fastest interval when new items arrive. New
+    items are passed to a callback from a background thread (start), or
+    yielded by iterating the watcher, synchronously or with async for.'''
+
+    def __init__(self, hm, callback=None, hm_token=None, mode='all',
+                 reset=False, min_interval=30, max_interval=600, backoff=2):
+        '''
+        Args:
+            HypeM hm: client to poll with
+            Optional:
+            callable callback: called with each list of new items when the
+                watcher runs in the background
+            string hm_token: token of the watched account (defaults to the
+                client's)
+            string mode: mode of feed to fetch
+            bool reset: call reset_feed_count after fetching new items
+            number min_interval: seconds between polls while active
+            number max_interval: max seconds between polls while idle
+            number backoff: factor the interval grows by after an idle poll
+        '''
+        self._hm = hm
+        self._callback = callback
+        self._hm_token = hm._assert_hm_token(hm_token)
+        self._mode = mode
+        self._reset = reset
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self.interval = min_interval
+        self._count = 0
+        self._seen = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _item_id(item):
+        for field in ('itemid', 'id'):
+            if isinstance(item, dict) and field in item:
+                return item[field]
+        return json.dumps(item, sort_keys=True)
+
+    def poll(self):
+        '''Checks the feed count once, fetching the feed if it rose, and
+        adapts the interval. Returns the list of new items.'''
+        with self._hm.refreshing():
+            count = self._hm.feed_count(hm_token=self._hm_token)
+            if isinstance(count, dict):
+                count = count.get('count', 0)
+            count = int(count)
+            items = []
+            if count > self._count:
+                feed = self._hm.feed(hm_token=self._hm_token,
+                                     mode=self._mode)
+                items = [item for item in feed
+                         if self._item_id(item) not in self._seen]
+                self._seen = set(self._item_id(item) for item in feed)
+                if self._reset:
+                    self._hm.reset_feed_count(hm_token=self._hm_token)
+                    count = 0
+        self._count = count
+        if items:
+            self.interval = self._min_interval
+        else:
+            self.interval = min(self.interval * self._backoff,
+                                self._max_interval)
+        return items
+
+    def start(self):
+        '''Starts polling in a background thread, passing new items to the
+        callback'''
+        assert self._callback, 'A callback is required to run in background'
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stops the background thread or iteration after its current poll'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        for items in self:
+            self._callback(items)
+
+    def __iter__(self):
+        '''Yields each non-empty list of new items, until stop()'''
+        while not self._stop.is_set():
+            items = self.poll()
+            if items:
+                yield items
+            self._stop.wait(self.interval)
+
+    async def __aiter__(self):
+        '''Yields each non-empty list of new items, until stop(), polling in
+        the event loop's default executor'''
+        loop = asyncio.get_running_loop()
+        while not self._stop.is_set():
+            items = await loop.run_in_executor(None, self.poll)
+            if items:
+                yield items
+            await asyncio.sleep(self.interval)
+
+
+class _WarmCall(object):
+    '''A call kept warm by a CacheWarmer'''
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.key = None
+        self.due = 0.0
+        self.hits = 0
+
+
+class CacheWarmer(object):
+    '''Keeps registered calls warm in the memo by fetching them again
+    shortly before their entries expire, so callers almost always hit the
+    cache. Refresh times are jittered so that entries stored together are
+    not all refreshed at once. When several calls are due, those read most
+    often since their last refresh go first, and calls read fewer than
+    min_hits times are left to expire. The warmer registers itself as a
+    request hook of the client to count reads.'''
+
+    def __init__(self, hm, lead=60, jitter=30, workers=4, min_hits=0):
+        '''
+        Args:
+            HypeM hm: client whose memo is kept warm
+            Optional:
+            number lead: seconds before expiry at which a call is refreshed
+            number jitter: max seconds by which refreshes are moved earlier
+            int workers: max number of concurrent refreshes
+            int min_hits: reads since its last refresh needed for a call to
+                be refreshed again
+        '''
+        self._hm = hm
+        self._lead = lead
+        self._jitter = jitter
+        self._workers = workers
+        self._min_hits = min_hits
+        self._calls = []
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        hm.add_hook(self)
+
+    def register(self, method, *args, **kwargs):
+        '''Fetches hm.method(*args, **kwargs) and keeps it warm'''
+        call = _WarmCall(method, args, kwargs)
+        self._refresh(call)
+        with self._lock:
+            self._calls.append(call)
+
+    def _refresh(self, call):
+        with self._hm.refreshing() as stored:
+            getattr(self._hm, call.method)(*call.args, **call.kwargs)
+        key, ttl = stored[-1] if stored else (None, 0)
+        with self._lock:
+            self._by_key.pop(call.key, None)
+            call.key = key
+            self._by_key[key] = call
+            call.hits = 0
+            if ttl <= 0 or ttl == float('inf'):
+                # not cached, or never expires: nothing to keep warm
+                call.due = float('inf')
+            else:
+                call.due = (time.time() + ttl - self._lead -
+                            random.uniform(0, self._jitter))
+
+    def run_pending(self):
+        '''Refreshes the calls that are due, hottest first. Returns the
+        number of calls refreshed.'''
+        now = time.time()
+        with self._lock:
+            due = [call for call in self._calls if call.due <= now]
+            cold = [call for call in due if call.hits < self._min_hits]
+            for call in cold:
+                call.due = float('inf')
+            due = sorted((call for call in due if call not in cold),
+                         key=lambda call: -call.hits)
+        if not due:
+            return 0
+        with ThreadPoolExecutor(self._workers) as executor:
+            for future in [executor.submit(self._refresh, call)
+                           for call in due]:
+                try:
+                    future.result()
+                except Exception as e:
+                    warnings.warn('Cache refresh failed: ' + repr(e),
+                                  RuntimeWarning)
+        return len(due)
+
+    def start(self, interval=1):
+        '''Runs pending refreshes every interval seconds in a background
+        thread'''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.run_pending()
+
+    def before(self, context):
+        pass
+
+    def after(self, context):
+        if context['phase'] != 'cache':
+            return
+        call = self._by_key.get(context['key'])
+        if call is not None:
+            call.hits += 1
+            if call.due == float('inf') and not context.get('hit'):
+                # a call left to expire is read again: warm it next run
+                call.due = 0.0
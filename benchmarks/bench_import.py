@@ -0,0 +1,36 @@
+'''Measures the time taken by `import HypeM` in a fresh interpreter, and
+which heavy dependencies it pulls in.
+
+Usage: python benchmarks/bench_import.py [runs]'''
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBE = '''
+import sys, time
+start = time.perf_counter()
+import HypeM
+elapsed = time.perf_counter() - start
+print(elapsed, 'bs4' in sys.modules, 'lxml' in sys.modules)
+'''
+
+
+def time_import():
+    '''Returns (seconds, bs4 imported?, lxml imported?) for one import'''
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT)
+    elapsed, bs4, lxml = output.decode().split()
+    return float(elapsed), bs4 == 'True', lxml == 'True'
+
+
+def main(runs=20):
+    results = [time_import() for _ in range(runs)]
+    times = [r[0] * 1000 for r in results]
+    print('import HypeM: median {:.1f} ms, min {:.1f} ms over {} runs'.format(
+        statistics.median(times), min(times), runs))
+    print('bs4 imported: {}, lxml imported: {}'.format(*results[-1][1:]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,74 @@
+'''Measures the scrape parsing hot path over the track page corpus in
+test/fixtures: pages parsed per second and peak memory (tracemalloc) of
+parse_track_tags and parse_track_source, for each installed BeautifulSoup
+parser backend.
+
+Usage: python benchmarks/bench_parse.py [runs]'''
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from HypeM import parse_track_source, parse_track_tags  # noqa: E402
+
+PARSERS = ['lxml', 'html.parser', 'html5lib']
+
+
+def corpus():
+    '''Returns [(name, html)] of the fixture pages'''
+    pages = []
+    for path in sorted(glob.glob(os.path.join(ROOT, 'test', 'fixtures',
+                                              '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages.append((os.path.basename(path), f.read()))
+    return pages
+
+
+def installed(parser):
+    from bs4 import BeautifulSoup
+    from bs4 import FeatureNotFound
+    try:
+        BeautifulSoup('<p></p>', parser)
+    except FeatureNotFound:
+        return False
+    return True
+
+
+def measure(parse, parser, pages, runs):
+    '''Returns (pages per second, peak bytes of one parse)'''
+    start = time.perf_counter()
+    for _ in range(runs):
+        for _, html in pages:
+            parse(html, parser)
+    rate = runs * len(pages) / (time.perf_counter() - start)
+    peak = 0
+    for _, html in pages:
+        tracemalloc.start()
+        parse(html, parser)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return rate, peak
+
+
+def main(runs=50):
+    pages = corpus()
+    size = sum(len(html) for _, html in pages) / len(pages)
+    print('{} pages, {:.0f} KB on average, {} runs'.format(
+        len(pages), size / 1024, runs))
+    print('{:12} {:20} {:>10} {:>10}'.format('parser', 'function',
+                                             'pages/s', 'peak KB'))
+    for parser in PARSERS:
+        if not installed(parser):
+            print('{:12} not installed'.format(parser))
+            continue
+        for parse in (parse_track_tags, parse_track_source):
+            rate, peak = measure(parse, parser, pages, runs)
+            print('{:12} {:20} {:10.0f} {:10.0f}'.format(
+                parser, parse.__name__, rate, peak / 1024))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
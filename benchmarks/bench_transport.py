@@ -0,0 +1,95 @@
+'''Measures requests per second through each HypeM transport, against a
+local threaded server or a real host, with concurrent client threads.
+
+The local server speaks HTTP/1.1 only, so it measures each transport's
+per-request overhead and pooling; HTTP/2 multiplexing only shows against a
+host that negotiates it (pass its url).
+
+Usage: python benchmarks/bench_transport.py [requests] [threads] [url]'''
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from HypeMTransport import (HttpxTransport, RequestsTransport,  # noqa: E402
+                            Urllib3Transport)
+
+BODY = b'{"itemid": "2fv7a", "title": "benchmark"}' * 50
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; don't let Nagle's algorithm
+    # hold the body back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def transports(threads):
+    '''Yields (name, factory) for every transport that can be built here'''
+    yield 'requests', lambda: RequestsTransport(pool_maxsize=threads)
+    yield 'urllib3', lambda: Urllib3Transport(maxsize=threads)
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        return
+    yield 'httpx h1', lambda: HttpxTransport(http2=False,
+                                             max_connections=threads)
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return
+    yield 'httpx h2', lambda: HttpxTransport(http2=True,
+                                             max_connections=threads)
+
+
+def run(transport, url, requests, threads):
+    '''Returns requests per second of requests GETs over threads threads'''
+    def get(_):
+        response = transport.request('GET', url)
+        response.content
+        assert response.status_code == 200, response.status_code
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(get, range(threads)))  # warm up the connections
+        start = time.perf_counter()
+        list(pool.map(get, range(requests)))
+        return requests / (time.perf_counter() - start)
+
+
+def main(requests=2000, threads=16, url=None):
+    server = None
+    if url is None:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d/' % server.server_port
+    print('{} GETs of {} over {} threads'.format(requests, url, threads))
+    try:
+        for name, factory in transports(threads):
+            transport = factory()
+            try:
+                rate = run(transport, url, requests, threads)
+            finally:
+                transport.close()
+            print('{:10} {:8.0f} req/s'.format(name, rate))
+    finally:
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]], *args[2:])
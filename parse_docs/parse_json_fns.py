@@ -4,7 +4,7 @@ from LazyScripts.LazyJSON import read_json
 
 # string to format for GET methods
 GET_METHOD_STR = '''
-    @BaseAPI._memoize
+    @_memoize
     def {0}(self, {1}):
         """{2}
         {3} method
@@ -24,7 +24,7 @@ GET_METHOD_STR = '''
 
         return self._get(query_string)'''
 # string to format for POST/DELETE methods
-POST_METHOD_STR = '''
+POST_METHOD_STR = '''{9}
     def {0}(self, {1}):
         """{2}
         {3} method
@@ -40,7 +40,7 @@ POST_METHOD_STR = '''
         {8}
 
         payload = self._parse_payload(locals().copy(), {7})
-        endpoint = '{6}'  + self._param('hm_token', self.hm_token)
+        endpoint = '{6}'{10}
 
         return self._post(endpoint, payload)'''
 # page/count params are not always included when they are supported;
@@ -54,11 +54,21 @@ COUNT_PARAM = {'required': False, 'allowMultiple': False, 'name': 'count',
 ENDPOINT_ARG_REGEX = r'{(\w*)}'  # used to parse endpoint-specific args
 DEFAULT_ARG_REGEX = r"\(default is '(\w*)'"
 # for indentation-level-formatting:
+# new line, one tab
+NL1T = '\n    '
 # new line, two tabs
 NL2T = '\n        '
 # new line, three tabs
 NL3T = '\n            '
 REQUIRE_HM_TOKEN = """hm_token = self._assert_hm_token(hm_token)"""
+# query string of POST/DELETE endpoints taking the per-call hm_token
+HM_TOKEN_QUERY = """ + '?' + self._param('hm_token', hm_token)"""
+# read methods whose memoized results each mutating method makes stale
+INVALIDATES = {'toggle_favorite': ['favorites_me'],
+               'add_playlist': ['playlist_me', 'favorites_me'],
+               'remove_playlist': ['playlist_me'],
+               'log_user_action': ['history_me'],
+               'reset_feed_count': ['feed_count']}
 
 
 def parse_all_docs():
@@ -137,7 +147,7 @@ def format_operation(resource_path, operation, endpoint_args):
     # list of elements used to format docstring
     # (I like this because it's enumerated in the same way as the
     # format string)
-    format_list = [''] * 9
+    format_list = [''] * 11
     format_list[0] = operation['nickname']
     format_list[1] = ', '.join(required_params + optional_params)
     format_list[2] = NL2T.join([operation['summary'],
@@ -151,6 +161,11 @@ def format_operation(resource_path, operation, endpoint_args):
         format_list[8] = REQUIRE_HM_TOKEN
     if assertions:
         format_list[8] += '\n'.join(assertions)
+    if operation['nickname'] in INVALIDATES:
+        format_list[9] = NL1T + '@_invalidates({})'.format(', '.join(
+            repr(name) for name in INVALIDATES[operation['nickname']]))
+    if 'hm_token=None' in required_params:
+        format_list[10] = HM_TOKEN_QUERY
     if operation['httpMethod'] == 'GET':
         return GET_METHOD_STR.format(*format_list)
     else:
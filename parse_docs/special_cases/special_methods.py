@@ -89,29 +89,53 @@
 
     def _get_soup(self, url):
         '''Returns a BeautifulSoup object for a given URL'''
-        req = self.session.get(url)
-        self._check_status(req)
-        return BeautifulSoup(req.text, 'lxml')
-
-    @BaseAPI._memoize
+        return self._scrape(url, _soup)
+
+    def _scrape(self, url, parse):
+        '''Fetches the page at url and returns parse(html, html_parser),
+        run in parse_pool if the instance has one. Within _sharing_pages,
+        track pages are fetched and parsed once for all parse functions.'''
+        self._check_memo(url)
+        pages = getattr(_memo_frames, 'pages', None)
+        if pages is None or parse.__name__ not in _PAGE_PARSES:
+            return self._fetch_parse(url, parse)
+        if url not in pages:
+            pages[url] = self._fetch_parse(url, parse_track_page)
+        return pages[url][parse.__name__]
+
+    def _fetch_parse(self, url, parse):
+        with self._span('soup', url=url):
+            req = self._send('GET', url)
+            with self._span('parse'):
+                if self.parse_pool is None:
+                    return parse(req.text, self.html_parser)
+                return self.parse_pool.submit(parse, req.text,
+                                              self.html_parser).result()
+
+    @contextmanager
+    def _sharing_pages(self):
+        '''Within the block, the scraping methods called by this thread
+        share each track page: it is fetched and parsed once, by
+        parse_track_page, while each method's result is memoized as usual'''
+        previous = getattr(_memo_frames, 'pages', None)
+        _memo_frames.pages = {}
+        try:
+            yield
+        finally:
+            _memo_frames.pages = previous
+
+    @_memoize
     def get_track_tags(self, track_id):
         '''Scrapes the tags for a given, if any
         Args:
             - string track_id: track id of the song on HypeM
         Returns list of genre tags.'''
 
-        genre_tags = []
-        soup = self._get_soup('http://hypem.com/track/' + track_id)
-        tag_box = soup.find('ul', 'tags')
-        if not tag_box:
-            return genre_tags
-        tags = tag_box.find_all('li')
-        if tags:
-            for tag in tags:
-                genre_tags.append(tag.text)
-        return genre_tags
-
-    @BaseAPI._memoize
+        return self._scrape('http://hypem.com/track/' + track_id,
+                            parse_track_tags)
+
+    @_memoize
+    @_result_ttl(_stream_ttl)
     def get_track_stream(self, track_id):
         '''Scrapes the link to the raw mp3 of a track.
         Args:
@@ -119,26 +143,15 @@
         credit to @fzakaria: https://github.com/fzakaria/HypeScript
         Returns url to mp3 stream'''
 
-        soup = self._get_soup('http://hypem.com/track/' + track_id)
-        display_list = soup.find(id='displayList-data')
-        if display_list is None:
-            # if there is no display list, return empty string
-            return ''
-        # load the display_list variable as json, and get 1st element
-        # (there may be more elements in display_list, but 1st should
-        # be the specified track)
-        track_list = json.loads(display_list.text)
-        track_json = track_list['tracks'][0]
-        key = track_json['key']
-        id_ = track_json['id']
-        type_ = track_json['type']
-        if not type_:
-            # type_ is false if stream no longer available
+        source = self._scrape('http://hypem.com/track/' + track_id,
+                              parse_track_source)
+        if source is None:
+            # no display list, or the stream is no longer available
             return ''
         # get hypem to serve stream url
-        serve_url = 'http://hypem.com/serve/source/{}/{}'.format(id_, key)
-        song_data_response = self.session.get(serve_url,
-                                              headers={'Content-Type':
-                                                       'application/json'})
-        song_data = json.loads(song_data_response.text)
-        return song_data.get('url')
\ No newline at end of file
+        serve_url = 'http://hypem.com/serve/source/{}/{}'.format(*source)
+        song_data_response = self._send('GET', serve_url,
+                                        headers={'Content-Type':
+                                                 'application/json'})
+        song_data = self._decode(song_data_response)
+        return song_data.get('url')
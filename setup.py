@@ -5,7 +5,8 @@ from setuptools import setup
 version = '1.1.0'
 
 setup(name='HypeM.py',
-      py_modules=['HypeM'],
+      py_modules=['HypeM', 'HypeMCache', 'HypeMData', 'HypeMDownload',
+                  'HypeMTransport', 'HypeMWorkers'],
       version=version,
       description='Python 3 wrapper for the official HypeMachine API',
       author='James Wenzel',
@@ -16,5 +17,6 @@ setup(name='HypeM.py',
       license='Apache License 2.0',
       keywords=['hypem', 'music', 'hype', 'machine', 'blogs', 'api', 'blog'],
       classifiers=[],
-      install_requires=['beautifulsoup4 >= 4.4.1', 'baseapi >= 0.1.0']
+      install_requires=['beautifulsoup4 >= 4.4.1', 'baseapi >= 0.1.0'],
+      extras_require={'http2': ['httpx[http2]']}
       )
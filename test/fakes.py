@@ -0,0 +1,82 @@
+'''Offline stand-ins for the network, shared by the offline tests'''
+import datetime
+import json
+from HypeM import HypeM
+from HypeMTransport import RequestsTransport
+
+
+class FakeResponse(object):
+    '''Mimics the parts of requests.Response that HypeM uses'''
+
+    def __init__(self, body, status_code=200, url='', headers=None):
+        if isinstance(body, bytes):
+            self.content = body
+            body = body.decode('latin-1')
+        elif not isinstance(body, str):
+            body = json.dumps(body)
+        self.text = body
+        if not hasattr(self, 'content'):
+            self.content = body.encode('utf-8')
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers or {}
+        self.elapsed = datetime.timedelta(0)
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+    '''Stands in for requests.Session. Serves canned bodies for the first
+    route whose pattern is a substring of the requested URL; a route's value
+    may be a body, a FakeResponse or a callable taking (method, url, kwargs).
+    Unrouted URLs get a 404.'''
+
+    def __init__(self, routes=None):
+        self.routes = routes or {}
+        self.calls = []
+
+    def _respond(self, method, url, kwargs):
+        self.calls.append((method, url, kwargs.get('data')))
+        self.last_headers = kwargs.get('headers')
+        for pattern, body in self.routes.items():
+            if pattern in url:
+                if callable(body):
+                    body = body(method, url, kwargs)
+                if isinstance(body, FakeResponse):
+                    body.url = url
+                    return body
+                return FakeResponse(body, url=url)
+        return FakeResponse('not found', status_code=404, url=url)
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def request(self, method, url, **kwargs):
+        return self._respond(method, url, kwargs)
+
+    def get(self, url, **kwargs):
+        return self._respond('GET', url, kwargs)
+
+    def post(self, url, **kwargs):
+        return self._respond('POST', url, kwargs)
+
+    def put(self, url, **kwargs):
+        return self._respond('PUT', url, kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._respond('DELETE', url, kwargs)
+
+
+def make_client(routes=None, **kwargs):
+    '''Returns a HypeM instance served by a FakeSession, with an empty memo'''
+    HypeM.memo.clear()
+    hm = HypeM(**kwargs)
+    hm._session = FakeSession(routes)
+    hm.transport = RequestsTransport(hm._session)
+    return hm
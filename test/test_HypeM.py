@@ -13,11 +13,8 @@ class TestHypeM(unittest.TestCase):
         val2 = hm.get_artist_info('ratherbright')
         # check that the previous instance's call is cached
         test2 = HypeM()
-        # we access the function's debug attribute to get to the underlying
-        # method (since @BaseAPI._memoize returns a *wrapper* around the
-        # original method)
-
-        self.assertTrue((test2.get_artist_info.debug, 'ratherbright',
+        # memo keys are the method name plus the request's path and params
+        self.assertTrue(('get_artist_info', 'artists/ratherbright',
                          tuple()) in HypeM.memo)
         # and test that the memoizing works, I suppose
         self.assertEqual(val1, val2)
@@ -26,7 +23,7 @@ class TestHypeM(unittest.TestCase):
         "Aliases for methods are still properly cached"
         hm = HypeM()
         hm.get_site_info(hm.test_blog)
-        self.assertTrue((hm.get_blog.debug, hm.test_blog,
+        self.assertTrue(('get_site_info', 'blogs/' + str(hm.test_blog),
                          tuple()) in HypeM.memo)
 
     def test_get(self):
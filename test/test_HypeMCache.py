@@ -0,0 +1,343 @@
+import copy
+import fnmatch
+import gc
+import json
+import time
+import unittest
+from HypeMCache import (MISSING, CompressedCache, MemoryCache, RedisCache,
+                        RoutingCache, TrackIdentityMap)
+from fakes import make_client
+
+
+class FakeRedis(object):
+    '''In-process stand-in for the subset of redis.Redis used by RedisCache'''
+
+    def __init__(self):
+        self.data = {}
+        self.sets = {}
+        self.expires = {}
+        self.commands = []
+
+    def _live(self, name):
+        value, expires = self.data.get(name, (None, None))
+        if expires is not None and time.time() >= expires:
+            del self.data[name]
+            return None
+        return value
+
+    def _members(self, name):
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        expires = self.expires.get(name)
+        if expires is not None and time.time() >= expires:
+            self.sets.pop(name, None)
+            self.expires.pop(name)
+        return self.sets.get(name)
+
+    def get(self, name):
+        self.commands.append('GET')
+        return self._live(name)
+
+    def mget(self, names):
+        self.commands.append('MGET')
+        return [self._live(name) for name in names]
+
+    def set(self, name, value, px=None):
+        self.commands.append('SET')
+        expires = None if px is None else time.time() + px / 1000.0
+        self.data[name] = (value.encode('utf-8'), expires)
+
+    def delete(self, *names):
+        self.commands.append('DEL')
+        for name in names:
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            self.data.pop(name, None)
+            self.sets.pop(name, None)
+            self.expires.pop(name, None)
+
+    def sadd(self, name, member):
+        self.commands.append('SADD')
+        if self._members(name) is None:
+            self.sets[name] = set()
+        self.sets[name].add(member.encode('utf-8'))
+
+    def smembers(self, name):
+        self.commands.append('SMEMBERS')
+        return set(self._members(name) or ())
+
+    def pexpire(self, name, px, nx=False, gt=False):
+        "Models PEXPIRE on sets: NX and GT treat no expiry as infinite"
+        self.commands.append('PEXPIRE')
+        if self._members(name) is None:
+            return 0
+        current = self.expires.get(name)
+        expires = time.time() + px / 1000.0
+        if (nx and current is not None or
+                gt and (current is None or expires <= current)):
+            return 0
+        self.expires[name] = expires
+        return 1
+
+    def persist(self, name):
+        self.commands.append('PERSIST')
+        return int(self.expires.pop(name, None) is not None)
+
+    def scan_iter(self, match):
+        self.commands.append('SCAN')
+        return [name.encode('utf-8') for name in list(self.data)
+                if fnmatch.fnmatch(name, match) and self._live(name)]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.queued = []
+
+    def __getattr__(self, command):
+        return lambda *args, **kwargs: self.queued.append(
+            (command, args, kwargs))
+
+    def execute(self):
+        commands = list(self.redis.commands)
+        for command, args, kwargs in self.queued:
+            getattr(self.redis, command)(*args, **kwargs)
+        # one round trip
+        self.redis.commands = commands + ['PIPELINE']
+
+
+KEY = ('get_site_info', 'blogs/22830', (('hm_token', 'abc'),))
+
+
+class BackendTests(object):
+    '''Tests every backend must pass; mixed into a TestCase with a
+    make_backend method'''
+
+    def test_get_set_delete(self):
+        cache = self.make_backend()
+        self.assertIs(cache.get(KEY), MISSING)
+        cache.set(KEY, {'siteid': 22830}, 60)
+        self.assertEqual(cache.get(KEY), {'siteid': 22830})
+        self.assertIn(KEY, cache)
+        self.assertEqual(list(cache.keys()), [KEY])
+        cache.delete(KEY)
+        self.assertNotIn(KEY, cache)
+
+    def test_ttl(self):
+        cache = self.make_backend()
+        cache.set(KEY, [1], 0.01)
+        cache.set(('item', 'tracks/x', ()), [2], float('inf'))
+        time.sleep(0.02)
+        self.assertIs(cache.get(KEY), MISSING)
+        self.assertEqual(cache.get(('item', 'tracks/x', ())), [2])
+
+    def test_many(self):
+        cache = self.make_backend()
+        keys = [('item', 'tracks/%d' % i, ()) for i in range(5)]
+        cache.set_many({key: i for i, key in enumerate(keys[:3])}, 60)
+        self.assertEqual(cache.get_many(keys, None), [0, 1, 2, None, None])
+        cache.clear()
+        self.assertEqual(list(cache.keys()), [])
+
+    def test_delete_method(self):
+        "delete_method drops a method's entries, or those of one token"
+        cache = self.make_backend()
+        other = ('get_site_info', 'blogs/1', (('hm_token', 'xyz'),))
+        blogs = ('list_blogs', 'blogs', ())
+        for key in (KEY, other, blogs):
+            cache.set(key, [1], 60)
+        cache.delete_method('get_site_info', 'abc')
+        self.assertEqual(sorted(cache.keys()), [other, blogs])
+        cache.set(KEY, [1], 60)
+        cache.delete_method('get_site_info')
+        self.assertEqual(list(cache.keys()), [blogs])
+        cache.delete_method('list_blogs', 'abc')
+        self.assertEqual(list(cache.keys()), [blogs])
+
+    def test_client(self):
+        "HypeM reads and writes through the backend"
+        cache = self.make_backend()
+        hm = make_client({'blogs/22830': {'siteid': 22830}}, cache=cache)
+        hm.get_blog(22830, hm_token='abc')
+        self.assertEqual(cache.get(KEY), {'siteid': 22830})
+        other = make_client({}, cache=cache)
+        self.assertEqual(other.get_site_info('22830', 'abc'),
+                         {'siteid': 22830})
+        self.assertEqual(other._session.calls, [])
+
+
+class TestMemoryCache(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        return MemoryCache()
+
+    def test_index_under_lock(self):
+        "The index is updated under the stripe lock of the key"
+        cache = self.make_backend()
+        index, (_, lock) = cache._index, cache._stripe(KEY)
+        updates = []
+
+        class Index(object):
+
+            def add(self, key):
+                updates.append(('add', lock.locked()))
+                index.add(key)
+
+            def discard(self, key):
+                updates.append(('discard', lock.locked()))
+                index.discard(key)
+
+        cache._index = Index()
+        cache.set(KEY, [1], 0.01)
+        time.sleep(0.02)
+        cache.get(KEY)
+        cache.delete(KEY)
+        self.assertEqual(updates, [('add', True), ('discard', True),
+                                   ('discard', True)])
+
+
+class TestRedisCache(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        self.redis = FakeRedis()
+        return RedisCache(client=self.redis)
+
+    def test_pipelined(self):
+        "Batch operations take one round trip"
+        cache = self.make_backend()
+        keys = [('item', 'tracks/%d' % i, ()) for i in range(20)]
+        cache.set_many({key: i for i, key in enumerate(keys)}, 60)
+        cache.get_many(keys)
+        self.assertEqual(self.redis.commands, ['PIPELINE', 'MGET'])
+
+    def test_index_expiry(self):
+        "Index sets expire with their entries, but never under permanent ones"
+        cache = self.make_backend()
+        forever = ('get_site_info', 'blogs/1', (('hm_token', 'abc'),))
+        cache.set(KEY, [1], 0.01)
+        cache.set(forever, [2], float('inf'))
+        cache.set(KEY, [1], 0.02)
+        time.sleep(0.03)
+        self.assertEqual(list(cache.keys()), [forever])
+        cache.set(KEY, [1], 0.01)
+        cache.delete_method('get_site_info', 'abc')
+        self.assertEqual(list(cache.keys()), [])
+
+
+class TestCompressedCache(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        return CompressedCache()
+
+    def test_budget(self):
+        "Entries are compressed and the least recently used evicted"
+        blogs = [{'siteid': i, 'sitename': 'Blog', 'recently_posted': [
+            {'artist': 'Artist', 'title': 'Title'}] * 10} for i in range(50)]
+        cache = CompressedCache(max_bytes=1000)
+        keys = [('list_blogs', 'blogs', (('page', str(i)),))
+                for i in range(20)]
+        cache.set(keys[0], blogs, 60)
+        self.assertLess(cache.nbytes, len(str(blogs)) / 10)
+        for key in keys[1:]:
+            cache.get(keys[0])
+            cache.set(key, blogs[:10], 60)
+        self.assertLessEqual(cache.nbytes, 1000)
+        self.assertEqual(cache.get(keys[0]), blogs)
+        self.assertEqual(cache.get(keys[-1]), blogs[:10])
+        self.assertIs(cache.get(keys[1]), MISSING)
+
+
+class TestRoutingCache(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        self.compressed = CompressedCache()
+        return RoutingCache({'get_blogs': self.compressed})
+
+    def test_routes(self):
+        "Entries go to their endpoint's backend"
+        cache = self.make_backend()
+        cache.set(('list_blogs', 'blogs', ()), [1], 60)
+        cache.set(KEY, [2], 60)
+        self.assertEqual(self.compressed.keys(),
+                         [('list_blogs', 'blogs', ())])
+        self.assertEqual(sorted(cache.keys()),
+                         [('get_site_info', 'blogs/22830',
+                           (('hm_token', 'abc'),)),
+                          ('list_blogs', 'blogs', ())])
+
+
+class TestTrackIdentityMap(unittest.TestCase):
+
+    def test_shared(self):
+        "Overlapping listings share one record, with the newest fields"
+        tracks = TrackIdentityMap()
+        hm = make_client({
+            'popular': [{'itemid': 'a', 'loved_count': 1, 'rank': 3},
+                        {'itemid': 'b', 'loved_count': 5}],
+            'tracks/a': {'itemid': 'a', 'loved_count': 2},
+            'latest': [{'itemid': 'b', 'loved_count': 6}, {'other': 1}]},
+            identity_map=tracks)
+        popular = hm.popular()
+        latest = hm.latest()
+        item = hm.item('a')
+        self.assertIs(popular[0].track, item.track)
+        self.assertIs(popular[1].track, latest[0].track)
+        self.assertEqual(item, {'itemid': 'a', 'loved_count': 2})
+        self.assertEqual(popular[0], {'itemid': 'a', 'loved_count': 2,
+                                      'rank': 3})
+        self.assertEqual(latest[1], {'other': 1})
+        self.assertIs(hm.popular()[0].track, tracks.get('a'))
+
+    def test_listings_apart(self):
+        "Fields of one listing do not show in another"
+        tracks = TrackIdentityMap()
+
+        def blog_tracks(method, url, kwargs):
+            siteid = url.split('blogs/')[1].split('/')[0]
+            return [{'itemid': 'a', 'artist': 'Artist', 'siteid': siteid,
+                     'posturl': 'http://blog' + siteid}]
+
+        hm = make_client({'blogs/': blog_tracks}, identity_map=tracks)
+        first = hm.get_blog_tracks(1)[0]
+        second = hm.get_blog_tracks(2)[0]
+        self.assertIs(first.track, second.track)
+        self.assertEqual((first['siteid'], first['posturl']),
+                         ('1', 'http://blog1'))
+        self.assertEqual(second['siteid'], '2')
+        self.assertEqual(json.loads(json.dumps(first)),
+                         {'itemid': 'a', 'artist': 'Artist', 'siteid': '1',
+                          'posturl': 'http://blog1'})
+        self.assertEqual(copy.copy(first), first)
+        self.assertIs(type(copy.copy(first)), dict)
+
+    def test_per_token(self):
+        "Accounts do not see each other's per-account fields"
+        tracks = TrackIdentityMap()
+        hm = make_client({'me/favorites': lambda method, url, kwargs: [
+            {'itemid': 'a', 'ts_loved_me': 1 if 'hm_token=A' in url else 2}],
+            'popular': [{'itemid': 'a', 'loved_count': 9}]},
+            identity_map=tracks)
+        mine = hm.favorites_me(hm_token='A')
+        theirs = hm.favorites_me(hm_token='B')
+        self.assertEqual(mine[0]['ts_loved_me'], 1)
+        self.assertEqual(theirs[0]['ts_loved_me'], 2)
+        self.assertIs(tracks.get('a', 'A'), mine[0].track)
+        self.assertNotIn('ts_loved_me', hm.popular()[0])
+
+    def test_weak(self):
+        "Records go once no response holds them"
+        tracks = TrackIdentityMap()
+        held = tracks.intern([{'itemid': 'a'}, {'itemid': 'b'}])
+        self.assertEqual(len(tracks), 2)
+        del held[0]
+        gc.collect()
+        self.assertEqual(len(tracks), 1)
+        self.assertIsNone(tracks.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import io
+import os
+import tempfile
+import unittest
+from urllib.parse import parse_qs, urlparse
+from HypeMData import (BlogTrackIndex, ChartRecorder, FriendCrawler,
+                       TrackSearchIndex)
+from fakes import make_client
+
+# a small friend graph: each user's friends
+GRAPH = {'a': ['b', 'c'], 'b': ['a', 'd'], 'c': ['d'], 'd': ['e'],
+         'e': ['a'], 'me': ['a', 'x'], 'x': []}
+
+
+def friends(method, url, kwargs):
+    '''Serves pages of GRAPH like /users/{username}/friends'''
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    if parsed.path.endswith('me/friends'):
+        username = 'me'
+    else:
+        username = parsed.path.split('/')[-2]
+    page, count = int(query['page'][0]), int(query['count'][0])
+    names = GRAPH[username][(page - 1) * count:page * count]
+    return [{'username': name} for name in names]
+
+
+class TestFriendCrawler(unittest.TestCase):
+
+    def test_crawl(self):
+        "Levels are crawled up to max_depth, paging through friends"
+        hm = make_client({'/friends': friends, 'me/friends': friends},
+                         hm_token='abc')
+        edges = io.StringIO()
+        crawler = FriendCrawler(hm, workers=3, max_depth=2, page_size=1,
+                                edge_file=edges)
+        self.assertEqual(crawler.crawl(['a']), 3)
+        self.assertEqual(sorted(crawler.names), ['a', 'b', 'c', 'd'])
+        self.assertEqual(sorted(edges.getvalue().splitlines()),
+                         ['a\tb', 'a\tc', 'b\ta', 'b\td', 'c\td'])
+        indptr, indices = crawler.csr()
+        a, d = crawler.ids['a'], crawler.ids['d']
+        self.assertEqual(sorted(crawler.names[i] for i in
+                                indices[indptr[a]:indptr[a + 1]]),
+                         ['b', 'c'])
+        self.assertEqual(indptr[d + 1] - indptr[d], 0)
+
+    def test_recrawl(self):
+        "Users fetched by an earlier crawl are not fetched again"
+        hm = make_client({'/friends': friends}, hm_token='abc')
+        crawler = FriendCrawler(hm, max_depth=1)
+        self.assertEqual(crawler.crawl(['a']), 1)
+        calls = len(hm._session.calls)
+        self.assertEqual(crawler.crawl(['a', 'a']), 0)
+        self.assertEqual(len(hm._session.calls), calls)
+        self.assertEqual(len(crawler.sources), 2)
+        # b was found but not fetched at max_depth, so it is crawled now
+        self.assertEqual(crawler.crawl(['b', 'a']), 1)
+        self.assertEqual(len(crawler.sources), 4)
+
+    def test_me_and_expand(self):
+        "The authenticated user's friends come from friends_me"
+        hm = make_client({'/friends': friends, 'me/friends': friends,
+                          '/favorites': [], 'users/': {'profile': True}},
+                         hm_token='abc')
+        crawler = FriendCrawler(hm, max_depth=5, expand=('user', 'tracks'))
+        crawler.crawl(['me'], me='me')
+        self.assertEqual(sorted(crawler.names),
+                         ['a', 'b', 'c', 'd', 'e', 'me', 'x'])
+        self.assertEqual(len(crawler.sources), 9)
+        self.assertEqual(crawler.profiles['x'], {'profile': True})
+        self.assertEqual(crawler.favorites['x'], [])
+        self.assertEqual(crawler.errors, {})
+
+
+# blogs that posted each track
+POSTS = {'t1': [1, 2], 't2': [2], 't3': [], 't4': [3, 1, 2]}
+
+
+def item_blogs(method, url, kwargs):
+    itemid = urlparse(url).path.split('/')[-2]
+    if itemid == 'bad':
+        return 'not json'
+    return [{'siteid': siteid, 'sitename': 'blog'}
+            for siteid in POSTS[itemid]]
+
+
+class TestBlogTrackIndex(unittest.TestCase):
+
+    def check(self, index):
+        self.assertEqual(sorted(index.blogs_for('t4')), [1, 2, 3])
+        self.assertEqual(index.blogs_for('t3'), [])
+        self.assertEqual(index.blogs_for('unknown'), [])
+        self.assertEqual(sorted(index.tracks_for(2)), ['t1', 't2', 't4'])
+        self.assertEqual(index.tracks_for(3), ['t4'])
+        self.assertEqual(index.tracks_for(99), [])
+
+    def test_build(self):
+        "Both directions are answered from item_blogs results"
+        hm = make_client({'/blogs': item_blogs})
+        index = BlogTrackIndex.build(hm, ['t1', 't2', 't3', 'bad'],
+                                     workers=4)
+        self.assertEqual(list(index.errors), ['bad'])
+        index.update(hm, ['t1', 't4'])
+        self.check(index)
+        self.assertEqual(len(hm._session.calls), 5)
+
+    def test_duplicates(self):
+        "Repeated itemids are fetched and indexed once"
+        hm = make_client({'/blogs': item_blogs})
+        index = BlogTrackIndex.build(hm, ['t1', 't1', 't2', 't1'])
+        self.assertEqual(sorted(index.itemids), ['t1', 't2'])
+        self.assertEqual(sorted(index.tracks_for(2)), ['t1', 't2'])
+        self.assertEqual(len(hm._session.calls), 2)
+
+    def test_save_load(self):
+        "An index survives a round trip through a file"
+        hm = make_client({'/blogs': item_blogs})
+        index = BlogTrackIndex.build(hm, POSTS)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.bin')
+            index.save(path)
+            self.check(BlogTrackIndex.load(path))
+
+
+TRACKS = [{'itemid': '1', 'artist': 'Rather Bright', 'title': 'Blue',
+           'tags': ['indie', 'pop']},
+          {'itemid': '2', 'artist': 'Brightside', 'title': 'Rather Not',
+           'tags': ['electronic']},
+          {'itemid': '3', 'artist': 'Other', 'title': 'Indie Song'},
+          {'title': 'no itemid'}]
+
+
+class TestTrackSearchIndex(unittest.TestCase):
+
+    def test_prefix_search(self):
+        "Every query word matches as a prefix of an artist/title/tag word"
+        index = TrackSearchIndex()
+        self.assertEqual(index.add(TRACKS), 3)
+
+        def ids(query):
+            return [track['itemid'] for track in index.search(query)]
+
+        self.assertEqual(ids('bri'), ['1', '2'])
+        self.assertEqual(ids('RATH bri'), ['1', '2'])
+        self.assertEqual(ids('indie'), ['1', '3'])
+        self.assertEqual(ids('rather blu'), ['1'])
+        self.assertEqual(ids('electro b'), ['2'])
+        self.assertEqual(ids('zzz'), [])
+        self.assertEqual(ids(''), [])
+        self.assertEqual(len(index.search('r', limit=1)), 1)
+
+    def test_update(self):
+        "Re-adding a track replaces its words"
+        index = TrackSearchIndex()
+        index.add(TRACKS)
+        index.add({'itemid': '1', 'artist': 'Renamed', 'title': 'Blue'})
+        self.assertEqual([t['itemid'] for t in index.search('bri')], ['2'])
+        self.assertEqual(index.search('renam')[0]['artist'], 'Renamed')
+
+    def test_lookup(self):
+        "The network search is only a fallback"
+        hm = make_client({'tracks?': [{'itemid': '9', 'artist': 'Remote',
+                                       'title': 'Found'}]})
+        index = TrackSearchIndex()
+        index.add(TRACKS)
+        self.assertEqual(index.lookup(hm, 'other')[0]['itemid'], '3')
+        self.assertEqual(hm._session.calls, [])
+        self.assertEqual(index.lookup(hm, 'remote')[0]['itemid'], '9')
+        self.assertEqual(len(hm._session.calls), 1)
+        self.assertEqual(index.search('found')[0]['itemid'], '9')
+
+
+class TestChartRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'charts.jsonl')
+        self.now = [{'itemid': 'a'}, {'itemid': 'b'}, {'itemid': 'c'}]
+        self.artists = [{'artist': 'x'}, {'artist': 'y'}]
+        self.hm = make_client({'popular?': lambda m, u, k: self.now,
+                               'artists?': lambda m, u, k: self.artists})
+        self.charts = {'now': ('popular', {'mode': 'now'}),
+                       'artists': ('popular_artists', {})}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_deltas(self):
+        "Only changed ranks are written, and snapshots can be rebuilt"
+        recorder = ChartRecorder(self.hm, self.path, self.charts)
+        self.assertEqual(recorder.snapshot(ts=1), ['now', 'artists'])
+        self.assertEqual(recorder.snapshot(ts=2), [])
+        self.now = [{'itemid': 'c'}, {'itemid': 'b'}]
+        self.assertEqual(recorder.snapshot(ts=3), ['now'])
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1], '{"t":3,"c":"now","n":2,"d":[[0,"c"]]}')
+        self.assertEqual(recorder.rebuild('now', at=2), ['a', 'b', 'c'])
+        self.assertEqual(recorder.rebuild('now'), ['c', 'b'])
+        self.assertEqual(recorder.rebuild('artists', at=3), ['x', 'y'])
+        self.assertIsNone(recorder.rebuild('now', at=0))
+        self.assertEqual(recorder.times('now'), [1, 3])
+
+    def test_resume(self):
+        "A new recorder continues from the file's last snapshots"
+        ChartRecorder(self.hm, self.path, self.charts).snapshot(ts=1)
+        recorder = ChartRecorder(self.hm, self.path, self.charts)
+        self.assertEqual(recorder.snapshot(ts=2), [])
+        self.artists = [{'artist': 'y'}, {'artist': 'x'}, {'artist': 'z'}]
+        self.assertEqual(recorder.snapshot(ts=3), ['artists'])
+        self.assertEqual(recorder.rebuild('artists'), ['y', 'x', 'z'])
+
+
+if __name__ == '__main__':
+    unittest.main()
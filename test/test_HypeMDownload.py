@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from HypeMDownload import DownloadError, Downloader
+from fakes import FakeResponse, make_client
+
+AUDIO = bytes(range(256)) * 40  # 10240 bytes
+
+
+def track_page(method, url, kwargs):
+    track_id = url.rsplit('/', 1)[1]
+    tracks = {'tracks': [{'id': track_id, 'key': 'k',
+                          'type': track_id != 'gone'}]}
+    return ('<script id="displayList-data">' + json.dumps(tracks) +
+            '</script>')
+
+
+class FakeCDN(object):
+    '''Serves AUDIO with Range support. Urls are valid until expire() and
+    transfers can be cut short.'''
+
+    def __init__(self):
+        self.version = 0
+        self.cut_at = None
+        self.ranges = []
+
+    def serve(self, method, url, kwargs):
+        return {'url': 'http://cdn/audio.mp3?v=%d' % self.version}
+
+    def expire(self):
+        self.version += 1
+
+    def audio(self, method, url, kwargs):
+        if not url.endswith('v=%d' % self.version):
+            return FakeResponse('expired', 403)
+        range_ = (kwargs.get('headers') or {}).get('Range')
+        self.ranges.append(range_)
+        start = int(range_[6:-1]) if range_ else 0
+        end = len(AUDIO) if self.cut_at is None else self.cut_at
+        self.cut_at = None
+        if range_:
+            headers = {'Content-Range': 'bytes %d-%d/%d' % (
+                start, len(AUDIO) - 1, len(AUDIO))}
+            return FakeResponse(AUDIO[start:end], 206, headers=headers)
+        return FakeResponse(AUDIO[:end], 200,
+                            headers={'Content-Length': str(len(AUDIO))})
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cdn = FakeCDN()
+        self.hm = make_client({'hypem.com/track/': track_page,
+                               'serve/source': self.cdn.serve,
+                               'cdn/audio': self.cdn.audio})
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def downloaded(self, track_id):
+        with open(os.path.join(self.dir.name, track_id + '.mp3'), 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        "Audio is streamed to disk in chunks, reporting progress"
+        progress = []
+        downloader = Downloader(self.hm, self.dir.name, chunk_size=1000,
+                                progress=lambda *p: progress.append(p))
+        path = downloader.download('a')
+        self.assertEqual(self.downloaded('a'), AUDIO)
+        self.assertEqual(path, os.path.join(self.dir.name, 'a.mp3'))
+        self.assertEqual(len(progress), 11)
+        self.assertEqual(progress[-1], ('a', len(AUDIO), len(AUDIO)))
+
+    def test_resume(self):
+        "A partial download is resumed with a Range request"
+        with open(os.path.join(self.dir.name, 'a.mp3.part'), 'wb') as f:
+            f.write(AUDIO[:3000])
+        Downloader(self.hm, self.dir.name).download('a')
+        self.assertEqual(self.cdn.ranges, ['bytes=3000-'])
+        self.assertEqual(self.downloaded('a'), AUDIO)
+
+    def test_interrupted(self):
+        "An interrupted transfer is retried from where it stopped"
+        self.cdn.cut_at = 5000
+        Downloader(self.hm, self.dir.name).download('a')
+        self.assertEqual(self.cdn.ranges, [None, 'bytes=5000-'])
+        self.assertEqual(self.downloaded('a'), AUDIO)
+
+    def test_expired_url(self):
+        "An expired stream url is resolved again"
+        downloader = Downloader(self.hm, self.dir.name)
+        self.hm.get_track_stream('a')
+        self.cdn.expire()
+        downloader.download('a')
+        self.assertEqual(self.downloaded('a'), AUDIO)
+        self.assertEqual(self.hm.get_track_stream('a'),
+                         'http://cdn/audio.mp3?v=1')
+
+    def test_refused(self):
+        "A url refused on every attempt fails with a clear error"
+        self.hm._session.routes['cdn/audio'] = FakeResponse('expired', 403)
+        with self.assertRaisesRegex(DownloadError, 'kept being refused'):
+            Downloader(self.hm, self.dir.name, retries=1).download('a')
+
+    def test_many_with_cap(self):
+        "Tracks download in parallel within the bandwidth cap"
+        downloader = Downloader(self.hm, self.dir.name, workers=3,
+                                max_bytes_per_sec=len(AUDIO) * 2)
+        start = time.monotonic()
+        results = downloader.download_many(['a', 'b', 'c', 'gone'])
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+        self.assertEqual(self.downloaded('c'), AUDIO)
+        self.assertIsInstance(results['gone'], DownloadError)
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name,
+                                                     'gone.mp3')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from HypeM import HypeM
+from HypeMTransport import (CassetteMiss, CassetteTransport, HttpxTransport,
+                            RequestsTransport, Urllib3Transport)
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+TRACK_PAGE = ('<ul class="tags"><li>indie</li></ul>'
+              '<script id="displayList-data">{"tracks": [{"id": "x", '
+              '"key": "k", "type": "normal"}]}</script>')
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    '''Answers every request with its method, path, form body and
+    X-Test header as JSON. Also serves a track page setting a cookie, and
+    its stream source, which requires the cookie, and a body cut short.
+    Paths under /moved/ redirect to the rest of the path.'''
+    protocol_version = 'HTTP/1.1'
+    handled = 0
+
+    def _send(self, status, body, content_type, cookie=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cookie:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _echo(self):
+        EchoHandler.handled += 1
+        if self.path.startswith('/moved/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[6:])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path.startswith('/track/'):
+            return self._send(200, TRACK_PAGE.encode(), 'text/html',
+                              'AUTH=%s; Path=/' % self.path[7:])
+        if self.path.startswith('/serve/source/'):
+            if 'AUTH=x' not in (self.headers.get('Cookie') or ''):
+                return self._send(403, b'{}', 'application/json')
+            return self._send(200, b'{"url": "http://cdn/x.mp3"}',
+                              'application/json')
+        if self.path.startswith('/truncated'):
+            self.send_response(200)
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.write(b'cut short')
+            self.close_connection = True
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+        body = json.dumps({'method': self.command, 'path': self.path,
+                           'form': form,
+                           'header': self.headers.get('X-Test')}).encode()
+        self.send_response(404 if 'missing' in self.path else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _echo
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTests(object):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+        cls.url = 'http://127.0.0.1:%d/' % cls.server.server_port
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.transport = self.make_transport()
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_get(self):
+        response = self.transport.request('GET', self.url + 'a?b=1',
+                                          headers={'X-Test': 'yes'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.text),
+                         {'method': 'GET', 'path': '/a?b=1', 'form': {},
+                          'header': 'yes'})
+        self.assertGreaterEqual(response.elapsed.total_seconds(), 0)
+
+    def test_form(self):
+        response = self.transport.request('POST', self.url + 'me',
+                                          data={'val': '2fv7a', 'n': 1})
+        self.assertEqual(json.loads(response.content.decode()),
+                         {'method': 'POST', 'path': '/me', 'header': None,
+                          'form': {'val': '2fv7a', 'n': '1'}})
+
+    def test_stream(self):
+        response = self.transport.request('GET', self.url + 'x', stream=True)
+        try:
+            body = b''.join(response.iter_content(4))
+        finally:
+            response.close()
+        self.assertEqual(json.loads(body.decode())['path'], '/x')
+
+    def test_errors(self):
+        "Network failures raise IOError"
+        response = self.transport.request('GET', self.url + 'truncated',
+                                          stream=True)
+        try:
+            with self.assertRaises(IOError):
+                b''.join(response.iter_content(4))
+        finally:
+            response.close()
+        closed = ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+        closed.server_close()
+        with self.assertRaises(IOError):
+            self.transport.request('GET', 'http://127.0.0.1:%d/' %
+                                   closed.server_port)
+
+    def test_scrape(self):
+        "Scraping works through the transport, redirects and cookies too"
+        transport = self.transport
+        url = self.url
+
+        class Local(object):
+            '''Sends hypem.com requests to the test server, track pages
+            by way of a redirect'''
+
+            def request(self, method, target, **kwargs):
+                target = target.replace('http://hypem.com/track/',
+                                        url + 'moved/track/')
+                target = target.replace('http://hypem.com/', url)
+                return transport.request(method, target, **kwargs)
+
+        HypeM.memo.clear()
+        hm = HypeM(transport=Local())
+        self.assertEqual(hm.get_track_tags('x'), ['indie'])
+        self.assertEqual(hm.get_track_stream('x'), 'http://cdn/x.mp3')
+
+    def test_client(self):
+        "HypeM sends every request through its transport"
+        hm = HypeM(transport=self.transport)
+        hm._api = self.url
+        hm._payload_auth = {}
+        self.assertTrue(hm._get('artists/a?q=1')['path'].startswith(
+            '/artists/a?q=1'))
+        self.assertEqual(hm._delete('me/x', {'v': 'y'})['method'], 'DELETE')
+        self.assertEqual(hm._put('me/x', {'v': 'y'})['form'], {'v': 'y'})
+        with self.assertRaises(Exception):
+            hm._get('missing?')
+
+
+class TestRequestsTransport(TransportTests, unittest.TestCase):
+
+    def make_transport(self):
+        return RequestsTransport(pool_maxsize=4)
+
+
+class TestUrllib3Transport(TransportTests, unittest.TestCase):
+
+    def make_transport(self):
+        return Urllib3Transport()
+
+
+@unittest.skipIf(httpx is None, 'httpx is not installed')
+class TestHttpxTransport(TransportTests, unittest.TestCase):
+
+    def make_transport(self):
+        # the test server only speaks HTTP/1.1; httpx falls back to it
+        return HttpxTransport(http2=True)
+
+
+class TestCassetteTransport(unittest.TestCase):
+
+    setUpClass = classmethod(TransportTests.setUpClass.__func__)
+    tearDownClass = classmethod(TransportTests.tearDownClass.__func__)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'traffic.cassette')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, requests):
+        recorder = CassetteTransport(self.path, mode='record')
+        try:
+            return [recorder.request(*request).text for request in requests]
+        finally:
+            recorder.close()
+
+    def test_replay(self):
+        "Recorded exchanges are replayed without the network"
+        recorded = self.record([('GET', self.url + 'a'),
+                                ('POST', self.url + 'b', {'x': 1, 'y': 2}),
+                                ('GET', self.url + 'missing')])
+        player = CassetteTransport(self.path)
+        self.addCleanup(player.close)
+        handled = EchoHandler.handled
+        self.assertEqual(player.request('GET', self.url + 'a').text,
+                         recorded[0])
+        response = player.request('POST', self.url + 'b',
+                                  data={'y': '2', 'x': '1'})
+        self.assertEqual(response.text, recorded[1])
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(player.request('GET', self.url + 'missing')
+                         .status_code, 404)
+        self.assertEqual(b''.join(player.request(
+            'GET', self.url + 'a', stream=True).iter_content(3)),
+            recorded[0].encode())
+        with self.assertRaises(CassetteMiss):
+            player.request('GET', self.url + 'c')
+        self.assertEqual(EchoHandler.handled, handled)
+
+    def test_occurrences(self):
+        "Repeated requests replay in order, then repeat the last"
+        self.record([('POST', self.url + 'n', {'i': 0})] * 1 +
+                    [('GET', self.url + 'x?%d' % i) for i in range(50)])
+        player = CassetteTransport(self.path)
+        self.addCleanup(player.close)
+        for i in range(50):
+            self.assertIn('/x?%d' % i,
+                          player.request('GET', self.url + 'x?%d' % i).text)
+        first = player.request('POST', self.url + 'n', {'i': 0}).text
+        self.assertEqual(player.request('POST', self.url + 'n',
+                                        {'i': 0}).text, first)
+
+    def test_client(self):
+        "A HypeM client replays a session, with simulated latency"
+        hm = HypeM(transport=CassetteTransport(self.path, mode='record'))
+        hm._api = self.url
+        expected = hm._get('tracks/a?')
+        hm.transport.close()
+        hm = HypeM(transport=CassetteTransport(self.path, latency=0.05))
+        hm._api = self.url
+        self.addCleanup(hm.transport.close)
+        start = time.perf_counter()
+        self.assertEqual(hm._get('tracks/a?'), expected)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,379 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from urllib.parse import parse_qs, urlparse
+from BaseAPI import APIError
+from HypeMWorkers import (ActionQueue, CacheWarmer, FeedWatcher, TokenPool,
+                          fetch_tag_range, scrape_tracks)
+from fakes import FakeResponse, make_client
+
+
+class TestActionQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.dead_letter = os.path.join(self.dir.name, 'dead.jsonl')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_posts_in_background(self):
+        "Events are posted by the workers with their original ts"
+        hm = make_client({'me/history': '1'}, hm_token='abc')
+        with ActionQueue(hm, workers=3,
+                         dead_letter=self.dead_letter) as actions:
+            for i in range(30):
+                actions.log('listen', 'item%d' % i, 10, ts=1000 + i)
+        posted = [call[2] for call in hm._session.calls]
+        self.assertEqual(len(posted), 30)
+        self.assertEqual(sorted(p['ts'] for p in posted),
+                         list(range(1000, 1030)))
+        self.assertTrue(all(p['hm_token'] == 'abc' for p in posted))
+        self.assertFalse(os.path.exists(self.dead_letter))
+
+    def test_log_does_not_wait(self):
+        "log() returns while the network is blocked"
+        release = threading.Event()
+
+        def slow(method, url, kwargs):
+            release.wait(5)
+            return '1'
+
+        hm = make_client({'me/history': slow}, hm_token='abc')
+        actions = ActionQueue(hm, workers=1, dead_letter=self.dead_letter)
+        for i in range(5):
+            actions.log('listen', 'item', 0)
+        self.assertLessEqual(len(hm._session.calls), 1)
+        release.set()
+        actions.close()
+        self.assertEqual(len(hm._session.calls), 5)
+
+    def test_dead_letter(self):
+        "Events failing every retry are dead-lettered, and can be requeued"
+        hm = make_client({'me/history': FakeResponse('', 500)},
+                         hm_token='abc')
+        actions = ActionQueue(hm, workers=2, retries=2, backoff=0,
+                              dead_letter=self.dead_letter)
+        actions.log('listen', 'a', 1, ts=5)
+        actions.flush()
+        self.assertEqual(len(hm._session.calls), 3)
+        with open(self.dead_letter) as f:
+            record = json.loads(f.read())
+        self.assertEqual((record['itemid'], record['ts']), ('a', 5))
+        hm._session.routes['me/history'] = '1'
+        self.assertEqual(actions.requeue_dead_letters(), 1)
+        actions.close()
+        self.assertEqual(hm._session.calls[-1][2]['ts'], 5)
+        self.assertEqual(os.path.getsize(self.dead_letter), 0)
+
+    def test_log_after_close(self):
+        "Events logged while or after closing are posted or dead-lettered"
+        hm = make_client({'me/history': '1'}, hm_token='abc')
+        actions = ActionQueue(hm, workers=2, dead_letter=self.dead_letter)
+        logger = threading.Thread(target=lambda: [
+            actions.log('listen', 'item', 0, ts=i) for i in range(200)])
+        logger.start()
+        actions.close()
+        logger.join()
+        actions.log('listen', 'item', 0, ts=200)
+        with open(self.dead_letter) as f:
+            dead = [json.loads(line)['error'] for line in f]
+        self.assertEqual(len(hm._session.calls) + len(dead), 201)
+        self.assertEqual(set(dead), {'queue closed'})
+
+
+def token_of(url):
+    return parse_qs(urlparse(url).query)['hm_token'][0]
+
+
+class TestTokenPool(unittest.TestCase):
+
+    def test_fetch(self):
+        "Every account's endpoints are fetched with its own token"
+        hm = make_client({'me/favorites': lambda m, url, kw: [token_of(url)],
+                          'me/history': lambda m, url, kw: [token_of(url)]})
+        pool = TokenPool(hm, workers=4, rate_limit=1000)
+        for i in range(10):
+            pool.add(i, hm_token='token%d' % i)
+        results = pool.fetch('favorites_me', 'get_my_history', count=5)
+        self.assertEqual(results[3], {'favorites_me': ['token3'],
+                                      'get_my_history': ['token3']})
+        self.assertEqual(len(hm._session.calls), 20)
+
+    def test_rate_limit(self):
+        "Calls with one token are spaced by the rate limit"
+        hm = make_client({'me/': []})
+        pool = TokenPool(hm, workers=4, rate_limit=20)
+        pool.add('a', hm_token='a')
+        start = time.monotonic()
+        pool.fetch('favorites_me', 'history_me', 'friends_me', 'feed')
+        self.assertGreaterEqual(time.monotonic() - start, 3 / 20.0 - 0.01)
+
+    def test_rate_limit_concurrent(self):
+        "Concurrent fetches share each token's rate limit"
+        times = []
+        hm = make_client({'me/': lambda m, url, kw: times.append(
+            time.monotonic()) or []})
+        pool = TokenPool(hm, workers=4, rate_limit=20)
+        pool.add('a', hm_token='a')
+        fetches = [threading.Thread(target=pool.fetch, args=(method,))
+                   for method in ('favorites_me', 'history_me', 'feed')]
+        for fetch in fetches:
+            fetch.start()
+        for fetch in fetches:
+            fetch.join()
+        times.sort()
+        self.assertGreaterEqual(times[-1] - times[0], 2 / 20.0 - 0.01)
+
+    def test_relogin(self):
+        "An expired token is replaced with get_token and the call retried"
+
+        def favorites(method, url, kwargs):
+            if token_of(url) == 'expired':
+                return FakeResponse('{"error": "bad token"}', 401)
+            return [token_of(url)]
+
+        hm = make_client({'me/favorites': favorites,
+                          'get_token': {'hm_token': 'fresh'}})
+        pool = TokenPool(hm, rate_limit=1000)
+        pool.add('a', hm_token='expired', username='a', password='pw')
+        pool.add('b', hm_token='expired')
+        results = pool.fetch('favorites_me')
+        self.assertEqual(results['a']['favorites_me'], ['fresh'])
+        self.assertIsInstance(results['b']['favorites_me'], APIError)
+        self.assertEqual(pool.tokens(), {'a': 'fresh', 'b': 'expired'})
+        self.assertEqual(hm.hm_token, '')
+
+
+# 300 tracks, three for each favorite count 0-99
+TAG_TRACKS = [{'itemid': 't%d' % i, 'loved_count': i % 100}
+              for i in range(300)]
+
+
+def tag_tracks(method, url, kwargs):
+    query = {k: int(v[0]) for k, v in parse_qs(urlparse(url).query).items()
+             if k != 'key'}
+    tracks = [track for track in TAG_TRACKS
+              if query['fav_from'] <= track['loved_count'] <= query['fav_to']]
+    start = (query['page'] - 1) * query['count']
+    return tracks[start:start + query['count']]
+
+
+class TestFetchTagRange(unittest.TestCase):
+
+    def test_split_and_merge(self):
+        "Dense windows are split until every track is fetched once"
+        hm = make_client({'tags/indie/tracks': tag_tracks})
+        tracks = fetch_tag_range(hm, 'indie', 0, 99, slices=4, page_size=10,
+                                 max_pages=2)
+        self.assertEqual(sorted(t['itemid'] for t in tracks),
+                         sorted(t['itemid'] for t in TAG_TRACKS))
+        windows = set(tuple(int(parse_qs(urlparse(call[1]).query)[k][0])
+                            for k in ('fav_from', 'fav_to'))
+                      for call in hm._session.calls)
+        self.assertIn((0, 24), windows)
+        self.assertIn((0, 12), windows)
+
+    def test_single_value_window(self):
+        "A window of one favorite count is paged through past max_pages"
+        hm = make_client({'tags/indie/tracks': tag_tracks})
+        tracks = fetch_tag_range(hm, 'indie', 5, 5, slices=1, page_size=1,
+                                 max_pages=1)
+        self.assertEqual(len(tracks), 3)
+        tracks = fetch_tag_range(hm, 'indie', 0, 10, slices=2, page_size=1,
+                                 max_pages=2)
+        self.assertEqual(len(tracks), 33)
+
+    def test_closed_windows_cached(self):
+        "Windows below closed_below are cached forever, others per policy"
+        hm = make_client({'tags/indie/tracks': tag_tracks}, cache_life=-1)
+        fetch_tag_range(hm, 'indie', 0, 99, slices=2, page_size=200,
+                        closed_below=50)
+        self.assertEqual(len(hm._session.calls), 2)
+        tracks = fetch_tag_range(hm, 'indie', 0, 99, slices=2,
+                                 page_size=200, closed_below=50)
+        self.assertEqual(len(tracks), 300)
+        self.assertEqual(len(hm._session.calls), 3)
+        self.assertIn('fav_from=50', hm._session.calls[-1][1])
+
+
+def track_page(method, url, kwargs):
+    track_id = url.rsplit('/', 1)[1]
+    tracks = {'tracks': [{'id': track_id, 'key': 'k',
+                          'type': track_id != 'gone'}]}
+    return ('<ul class="tags"><li>' + track_id + '</li><li>indie</li></ul>'
+            '<script id="displayList-data">' + json.dumps(tracks) +
+            '</script>')
+
+
+class TestScrapeTracks(unittest.TestCase):
+
+    def test_scrape(self):
+        "Pages parsed in processes give the results of the methods"
+        hm = make_client({'hypem.com/track/': track_page,
+                          'serve/source/a/k': {'url': 'http://cdn/a.mp3'}})
+        results = scrape_tracks(hm, ['a', 'gone', 'b'], threads=4,
+                                processes=2)
+        self.assertEqual(results['a'], {'tags': ['a', 'indie'],
+                                        'stream': 'http://cdn/a.mp3'})
+        self.assertEqual(results['gone'], {'tags': ['gone', 'indie'],
+                                           'stream': ''})
+        self.assertIsInstance(results['b'], Exception)
+        self.assertIsNone(hm.parse_pool)
+        # each page is fetched once for both fields
+        pages = sorted(call[1] for call in hm._session.calls
+                       if '/track/' in call[1])
+        self.assertEqual(pages, ['http://hypem.com/track/' + track_id
+                                 for track_id in ('a', 'b', 'gone')])
+        # memoized as the methods would be
+        calls = len(hm._session.calls)
+        self.assertEqual(hm.get_track_tags('a'), ['a', 'indie'])
+        self.assertEqual(hm.get_track_stream('a'), 'http://cdn/a.mp3')
+        self.assertEqual(len(hm._session.calls), calls)
+
+
+class FakeFeed(object):
+    '''Serves a feed and its unread count, which resets on POST'''
+
+    def __init__(self):
+        self.items = []
+        self.unread = 0
+
+    def publish(self, *itemids):
+        self.items = [{'itemid': i} for i in itemids] + self.items
+        self.unread += len(itemids)
+
+    def count(self, method, url, kwargs):
+        if method == 'POST':
+            self.unread = 0
+        return {'count': self.unread}
+
+    def feed(self, method, url, kwargs):
+        return self.items
+
+
+class TestFeedWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.feed = FakeFeed()
+        self.hm = make_client({'me/feed/count': self.feed.count,
+                               'me/feed?': self.feed.feed}, hm_token='abc')
+
+    def fetches(self):
+        return len([c for c in self.hm._session.calls
+                    if 'me/feed?' in c[1]])
+
+    def test_poll(self):
+        "feed is only fetched when the count rises, and backs off"
+        watcher = FeedWatcher(self.hm, min_interval=1, max_interval=4)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.interval, 2)
+        self.feed.publish('a', 'b')
+        self.assertEqual(watcher.poll(), [{'itemid': 'a'}, {'itemid': 'b'}])
+        self.assertEqual(watcher.interval, 1)
+        for _ in range(3):
+            self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.interval, 4)
+        self.feed.publish('c')
+        self.assertEqual(watcher.poll(), [{'itemid': 'c'}])
+        self.assertEqual(self.fetches(), 2)
+
+    def test_reset(self):
+        "reset_feed_count is called after new items when configured"
+        watcher = FeedWatcher(self.hm, reset=True)
+        self.feed.publish('a')
+        self.assertEqual(len(watcher.poll()), 1)
+        self.assertEqual(self.feed.unread, 0)
+        self.feed.publish('b')
+        self.assertEqual(watcher.poll(), [{'itemid': 'b'}])
+
+    def test_callback(self):
+        "A background watcher passes new items to its callback"
+        received = []
+        done = threading.Event()
+
+        def callback(items):
+            received.extend(items)
+            done.set()
+
+        watcher = FeedWatcher(self.hm, callback, min_interval=0.01,
+                              max_interval=0.01)
+        self.feed.publish('a')
+        watcher.start()
+        self.assertTrue(done.wait(5))
+        watcher.stop()
+        self.assertEqual(received, [{'itemid': 'a'}])
+
+    def test_async(self):
+        "The watcher is an async iterator"
+        watcher = FeedWatcher(self.hm, min_interval=0.01, max_interval=0.01)
+
+        async def first():
+            async for items in watcher:
+                watcher.stop()
+                return items
+
+        self.feed.publish('a')
+        self.assertEqual(asyncio.run(first()), [{'itemid': 'a'}])
+
+
+class TestCacheWarmer(unittest.TestCase):
+
+    def setUp(self):
+        self.versions = {'popular': 0, 'tags': 0}
+
+        def serve(name):
+            def respond(method, url, kwargs):
+                self.versions[name] += 1
+                return [self.versions[name]]
+            return respond
+
+        self.hm = make_client({'popular?': serve('popular'),
+                               'tags?': serve('tags')}, cache_life=10)
+
+    def test_refresh_before_expiry(self):
+        "Registered calls are refetched once within lead of expiring"
+        warmer = CacheWarmer(self.hm, lead=20, jitter=5)
+        warmer.register('popular', mode='now')
+        warmer.register('get_tags')
+        self.assertEqual(self.versions, {'popular': 1, 'tags': 1})
+        self.assertEqual(warmer.run_pending(), 2)
+        self.assertEqual(self.versions, {'popular': 2, 'tags': 2})
+        self.assertEqual(self.hm.popular(), [2])
+        self.assertEqual(self.versions['popular'], 2)
+
+    def test_not_due(self):
+        "Calls far from expiry are left alone"
+        warmer = CacheWarmer(self.hm, lead=1, jitter=1)
+        warmer.register('popular')
+        self.assertEqual(warmer.run_pending(), 0)
+
+    def test_hot_first_and_cold_skipped(self):
+        "Hot calls refresh first; calls read less than min_hits expire"
+        warmer = CacheWarmer(self.hm, lead=20, jitter=0, workers=1,
+                             min_hits=1)
+        warmer.register('list_tags')
+        warmer.register('popular')
+        order = []
+        refresh = warmer._refresh
+        warmer._refresh = lambda call: (order.append(call.method),
+                                        refresh(call))
+        self.hm.popular()
+        self.assertEqual(warmer.run_pending(), 1)
+        self.assertEqual(order, ['popular'])
+        self.assertEqual(self.versions['tags'], 1)
+        # a cold call read again after expiring is warmed again
+        self.hm.invalidate('list_tags')
+        self.hm.list_tags()
+        self.hm.popular()
+        self.hm.popular()
+        self.assertEqual(warmer.run_pending(), 2)
+        self.assertEqual(order, ['popular', 'popular', 'list_tags'])
+
+
+if __name__ == '__main__':
+    unittest.main()
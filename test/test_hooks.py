@@ -0,0 +1,107 @@
+import unittest
+from HypeM import RequestHook, SpanEmitter
+from fakes import make_client
+
+
+class RecordingHook(RequestHook):
+
+    def __init__(self):
+        self.events = []
+
+    def before(self, context):
+        self.events.append(('before', context['phase']))
+
+    def after(self, context):
+        self.events.append(('after', context['phase'], context['elapsed']))
+
+
+class FakeSpan(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.attributes = {}
+        self.ended = False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+class FakeSpanManager(object):
+
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.ended = True
+
+
+class FakeTracer(object):
+
+    def __init__(self):
+        self.spans = []
+
+    def start_as_current_span(self, name):
+        span = FakeSpan(name)
+        self.spans.append(span)
+        return FakeSpanManager(span)
+
+
+class TestHooks(unittest.TestCase):
+
+    def test_phases(self):
+        "Hooks see every phase of a memoized GET, properly nested"
+        hm = make_client({'artists/ratherbright': {'artist': 'x'}})
+        hook = RecordingHook()
+        hm.add_hook(hook)
+        hm.get_artist_info('ratherbright')
+        phases = [e[1] for e in hook.events if e[0] == 'before']
+        self.assertEqual(phases, ['encode', 'cache', 'get', 'network',
+                                  'decode'])
+        self.assertEqual(hook.events[-1][:2], ('after', 'get'))
+        self.assertTrue(all(e[2] >= 0 for e in hook.events
+                            if e[0] == 'after'))
+
+    def test_cache_hit(self):
+        "A memo hit is reported and skips the network phases"
+        hm = make_client({'artists/ratherbright': {'artist': 'x'}})
+        hm.get_artist_info('ratherbright')
+        contexts = []
+        hook = RequestHook()
+        hook.after = contexts.append
+        hm.add_hook(hook)
+        hm.get_artist_info('ratherbright')
+        self.assertEqual([c['phase'] for c in contexts], ['encode', 'cache'])
+        self.assertTrue(contexts[1]['hit'])
+
+    def test_error(self):
+        "A failing request still closes its phases, recording the error"
+        hm = make_client()
+        contexts = []
+        hook = RequestHook()
+        hook.after = contexts.append
+        hm.add_hook(hook)
+        with self.assertRaises(ValueError):
+            hm.get_artist_info('nobody')
+        network = [c for c in contexts if c['phase'] == 'network'][0]
+        self.assertEqual(network['status'], 404)
+        self.assertIsInstance(contexts[-1]['error'], ValueError)
+
+    def test_span_emitter(self):
+        "SpanEmitter opens and closes a span per phase with attributes"
+        hm = make_client({'me/feed/count': '3'}, hm_token='token')
+        tracer = FakeTracer()
+        hm.add_hook(SpanEmitter(tracer))
+        hm.feed_count()
+        self.assertEqual([s.name for s in tracer.spans],
+                         ['hypem.encode', 'hypem.cache', 'hypem.get',
+                          'hypem.network', 'hypem.decode'])
+        self.assertTrue(all(s.ended for s in tracer.spans))
+        self.assertEqual(tracer.spans[3].attributes['hypem.status'], 200)
+        self.assertFalse(tracer.spans[1].attributes['hypem.hit'])
+
+
+if __name__ == '__main__':
+    unittest.main()
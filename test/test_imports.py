@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    '''Runs code in a fresh interpreter, returning its stripped stdout'''
+    return subprocess.check_output([sys.executable, '-c', code],
+                                   cwd=ROOT).decode().strip()
+
+
+class TestImports(unittest.TestCase):
+
+    def test_no_eager_bs4(self):
+        "Importing HypeM does not import bs4 or lxml"
+        out = run('import sys, HypeM; '
+                  'print("bs4" in sys.modules, "lxml" in sys.modules)')
+        self.assertEqual(out, 'False False')
+
+    def test_bs4_on_scrape(self):
+        "bs4 is imported by the first scrape"
+        out = run('import sys; sys.path.insert(0, "test"); '
+                  'from fakes import make_client; '
+                  'hm = make_client({"hypem.com/track/": "<ul></ul>"}); '
+                  'print(hm.get_track_tags("x"), "bs4" in sys.modules)')
+        self.assertEqual(out, '[] True')
+
+
+if __name__ == '__main__':
+    unittest.main()
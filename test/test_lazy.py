@@ -0,0 +1,69 @@
+import json
+import unittest
+from HypeM import _FLAT_OBJECT, LazyList
+from HypeMCache import CompressedCache, TrackIdentityMap
+from fakes import make_client
+
+TRACKS = [{'itemid': 'a', 'title': 'say "itemid": "x"', 'tags': ['indie']},
+          {'itemid': 'b', 'thumb': {'itemid': 'nested'}},
+          {'title': 'no id'},
+          'not a track',
+          {'itemid': 'e', 'loved_count': 5}]
+
+
+class TestLazyList(unittest.TestCase):
+
+    def test_sequence(self):
+        "Items decode to the same values as json.loads"
+        items = LazyList(json.dumps(TRACKS, indent=1))
+        self.assertEqual(len(items), 5)
+        self.assertEqual(items, TRACKS)
+        self.assertEqual(items[-1], TRACKS[-1])
+        self.assertEqual(items[1:3], TRACKS[1:3])
+        self.assertEqual(list(reversed(items)), TRACKS[::-1])
+        self.assertEqual(LazyList(' [ ] '), [])
+        with self.assertRaises(IndexError):
+            items[5]
+
+    def test_on_access(self):
+        "Only accessed items are decoded, and each once"
+        items = LazyList(json.dumps(TRACKS))
+        first = items[0]
+        self.assertIs(items[0], first)
+        self.assertEqual(list(items._items), [0])
+        self.assertEqual(len(items._spans), 1)
+
+    def test_pluck(self):
+        "pluck projects a field without decoding flat items"
+        items = LazyList(json.dumps(TRACKS))
+        self.assertEqual(items.pluck('itemid'), ['a', 'b', None, None, 'e'])
+        self.assertEqual(items.pluck('tags', []),
+                         [['indie'], [], [], [], []])
+        # only the item that could not be indexed flat was decoded
+        self.assertEqual(sorted(items._items), [1, 3])
+
+    def test_portable_pattern(self):
+        "The index pattern avoids possessive quantifiers (Python 3.11+)"
+        self.assertNotIn('*+', _FLAT_OBJECT.pattern)
+        self.assertNotIn('++', _FLAT_OBJECT.pattern)
+
+    def test_client(self):
+        "lazy_lists returns array responses lazily, through the memo"
+        tracks = TrackIdentityMap()
+        hm = make_client({'popular': TRACKS[:2], 'tracks/a': {'itemid': 'a'}},
+                         lazy_lists=True, identity_map=tracks)
+        popular = hm.popular()
+        self.assertIsInstance(popular, LazyList)
+        self.assertIs(hm.popular(), popular)
+        self.assertIs(popular[0].track, hm.item('a').track)
+        self.assertEqual(popular.pluck('itemid'), ['a', 'b'])
+
+    def test_serialized(self):
+        "Serializing backends store LazyLists as lists"
+        cache = CompressedCache()
+        cache.set('k', {'tracks': LazyList(json.dumps(TRACKS))}, 60)
+        self.assertEqual(cache.get('k'), {'tracks': TRACKS})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import base64
+import json
+import time
+import unittest
+from HypeM import HypeM
+from fakes import make_client
+
+
+class TestMemo(unittest.TestCase):
+
+    def test_alias_kwargs_types(self):
+        "Aliases, kwargs and int/str args share one memo entry"
+        hm = make_client({'blogs/22830': {'siteid': 22830}})
+        hm.get_site_info(22830)
+        hm.get_blog(siteid=22830)
+        hm.get_site_info('22830')
+        self.assertEqual(len(hm._session.calls), 1)
+        self.assertIn(('get_site_info', 'blogs/22830', ()), HypeM.memo)
+
+    def test_defaults_dropped(self):
+        "Passing a default explicitly hits the same entry"
+        hm = make_client({'popular': []})
+        hm.popular()
+        hm.popular(mode='now')
+        hm.popular('now', page=None)
+        self.assertEqual(len(hm._session.calls), 1)
+        hm.popular(mode='remix')
+        self.assertEqual(len(hm._session.calls), 2)
+        self.assertIn(('popular', 'popular', (('mode', 'remix'),)),
+                      HypeM.memo)
+
+    def test_token_resolved(self):
+        "hm_token=None and the instance's token share an entry"
+        hm = make_client({'me/favorites': []}, hm_token='abc')
+        hm.favorites_me()
+        hm.favorites_me('abc')
+        hm.favorites_me(hm_token='abc', page=None)
+        self.assertEqual(len(hm._session.calls), 1)
+        hm.favorites_me('other')
+        self.assertEqual(len(hm._session.calls), 2)
+
+    def test_params_sorted(self):
+        "Param order does not matter"
+        hm = make_client({'tags/indie/tracks': []})
+        hm.get_tag_tracks('indie', page=2, count=5)
+        hm.get_tag_tracks('indie', count=5, page=2)
+        self.assertEqual(len(hm._session.calls), 1)
+
+    def test_scrapes_keyed_by_method(self):
+        "Scrapes of the same page are cached per method"
+        hm = make_client({'hypem.com/track/': '<ul class="tags"></ul>'})
+        hm.get_track_tags('2fv7a')
+        hm.get_track_tags('2fv7a')
+        hm.get_track_stream('2fv7a')
+        self.assertEqual(len(hm._session.calls), 2)
+
+    def test_expiry(self):
+        "Entries older than cache_life are fetched again"
+        hm = make_client({'tags': []}, cache_life=-1)
+        hm.list_tags()
+        hm.list_tags()
+        self.assertEqual(len(hm._session.calls), 2)
+
+    def test_policy(self):
+        "cache_policy overrides cache_life per method, alias and category"
+        hm = make_client({'tags': [], 'popular': [], 'me/feed/count': '0',
+                          'me/favorites': [], 'tracks/': {}},
+                         hm_token='abc', cache_life=-1,
+                         cache_policy={'list_tags': 60, 'get_popular': 60,
+                                       '/me': 0, 'feed_count': 60})
+        for _ in range(2):
+            hm.list_tags()
+            hm.get_tags()
+            hm.popular()
+            hm.favorites_me()
+            hm.feed_count()
+            hm.item('2fv7a')
+        paths = [call[1].split('?')[0].split('v2/')[1]
+                 for call in hm._session.calls]
+        self.assertEqual(sorted(paths),
+                         ['me/favorites', 'me/favorites', 'me/feed/count',
+                          'popular', 'tags', 'tracks/2fv7a', 'tracks/2fv7a'])
+        self.assertNotIn(('favorites_me', 'me/favorites',
+                          (('hm_token', 'abc'),)), HypeM.memo)
+
+    def test_invalidation(self):
+        "Mutations drop the affected reads, only for the calling token"
+        hm = make_client({'me/favorites': [], 'me/feed/count': '2',
+                          'me/playlists/1': []}, hm_token='abc')
+        hm.favorites_me()
+        hm.favorites_me('other')
+        hm.feed_count()
+        hm.playlist_me(1)
+        hm.toggle_favorite('item', '2fv7a')
+        self.assertNotIn(('favorites_me', 'me/favorites',
+                          (('hm_token', 'abc'),)), HypeM.memo)
+        self.assertIn(('favorites_me', 'me/favorites',
+                       (('hm_token', 'other'),)), HypeM.memo)
+        self.assertIn(('feed_count', 'me/feed/count',
+                       (('hm_token', 'abc'),)), HypeM.memo)
+        hm.reset_my_unread()
+        self.assertNotIn(('feed_count', 'me/feed/count',
+                          (('hm_token', 'abc'),)), HypeM.memo)
+        self.assertEqual(len(HypeM.memo), 2)
+        hm.invalidate('get_my_playlist')
+        self.assertEqual(len(HypeM.memo), 1)
+
+    def test_refreshing(self):
+        "refreshing() skips memo lookups but stores what it fetches"
+        counts = iter(range(10))
+        hm = make_client({'me/feed/count': lambda m, u, k: next(counts)},
+                         hm_token='abc')
+        self.assertEqual(hm.feed_count(), 0)
+        with hm.refreshing():
+            self.assertEqual(hm.feed_count(), 1)
+        self.assertEqual(hm.feed_count(), 1)
+
+    def stream_ttl(self, url, available=True, **kwargs):
+        '''Returns the ttl get_track_stream caches url with'''
+        tracks = {'tracks': [{'id': 'x', 'key': 'k', 'type': available}]}
+        hm = make_client({'hypem.com/track/': '<script id="displayList-data">'
+                          + json.dumps(tracks) + '</script>',
+                          'serve/source': {'url': url}}, **kwargs)
+        with hm.refreshing() as stored:
+            hm.get_track_stream('x')
+        return stored[0][1]
+
+    def test_stream_expiry(self):
+        "Stream urls are cached until shortly before their signed expiry"
+        now = time.time()
+        ttl = self.stream_ttl('http://cdn/a.mp3?Expires=%d&Signature=s'
+                              % (now + 600))
+        self.assertAlmostEqual(ttl, 540, delta=2)
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))
+        ttl = self.stream_ttl('http://s3/a.mp3?X-Amz-Date=%s&X-Amz-Expires='
+                              '300' % amz_date)
+        self.assertAlmostEqual(ttl, 240, delta=2)
+        policy = base64.b64encode(json.dumps({'Statement': [{'Condition': {
+            'DateLessThan': {'AWS:EpochTime': int(now) + 1000}}}]}).encode())
+        policy = policy.decode().replace('+', '-').replace('=', '_')
+        ttl = self.stream_ttl('http://cf/a.mp3?Policy=' +
+                              policy.replace('/', '~'))
+        self.assertAlmostEqual(ttl, 940, delta=2)
+        self.assertLessEqual(self.stream_ttl('http://cdn/a.mp3?expires=%d'
+                                             % (now + 30)), 0)
+        self.assertEqual(self.stream_ttl('http://cdn/a.mp3'), 3600)
+
+    def test_stream_negative(self):
+        "Unavailable streams are cached for stream_negative_life"
+        self.assertEqual(self.stream_ttl('', available=False),
+                         HypeM.stream_negative_life)
+        self.assertEqual(self.stream_ttl('', available=False,
+                                         cache_policy={'get_track_stream': 0}),
+                         0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import unittest
+from HypeM import parse_track_page, parse_track_source, parse_track_tags
+from fakes import make_client
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+PARSERS = ['lxml', 'html.parser']
+try:
+    import html5lib  # noqa: F401
+    PARSERS.append('html5lib')
+except ImportError:
+    pass
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name + '.html'),
+              encoding='utf-8') as f:
+        return f.read()
+
+
+class TestParse(unittest.TestCase):
+    '''Parses the track page corpus with every installed parser'''
+
+    def check(self, parse, name, expected):
+        for parser in PARSERS:
+            with self.subTest(parser=parser):
+                self.assertEqual(parse(fixture(name), parser), expected)
+
+    def test_tags(self):
+        self.check(parse_track_tags, 'track_tags',
+                   ['Indie', 'Electronic', 'Chillwave', 'Dream Pop'])
+        self.check(parse_track_source, 'track_tags',
+                   ('2fv7a', 'a7c5f3b0e2d9c3a1f4e6b8d0c2a4e6f8'))
+
+    def test_no_tags(self):
+        self.check(parse_track_tags, 'track_no_tags', [])
+
+    def test_unavailable(self):
+        self.check(parse_track_source, 'track_unavailable', None)
+        self.check(parse_track_tags, 'track_unavailable', ['Rock'])
+
+    def test_multiple(self):
+        "The page's own track is the first of its display list"
+        self.check(parse_track_source, 'track_multiple',
+                   ('2h8bn', 'c0ffee00c0ffee00c0ffee00c0ffee00'))
+        self.check(parse_track_tags, 'track_multiple', ['House', 'Deep House'])
+
+    def test_page(self):
+        "parse_track_page gives both results from one parse"
+        self.check(parse_track_page, 'track_unavailable',
+                   {'parse_track_tags': ['Rock'], 'parse_track_source': None})
+
+    def test_no_display_list(self):
+        self.assertIsNone(parse_track_source('<html><body></body></html>'))
+
+
+class TestScrapeMethods(unittest.TestCase):
+    '''get_track_tags and get_track_stream over the corpus, offline'''
+
+    def setUp(self):
+        self.hm = make_client({
+            'hypem.com/track/2fv7a': fixture('track_tags'),
+            'hypem.com/track/2cbxm': fixture('track_unavailable'),
+            'hypem.com/track/2h8bn': fixture('track_multiple'),
+            'serve/source/2fv7a/a7c5': {'url': 'http://cdn/2fv7a.mp3'},
+            'serve/source/2h8bn/c0ff': {'url': 'http://cdn/2h8bn.mp3'}})
+
+    def test_tags(self):
+        self.assertEqual(self.hm.get_track_tags('2fv7a'),
+                         ['Indie', 'Electronic', 'Chillwave', 'Dream Pop'])
+
+    def test_stream(self):
+        self.assertEqual(self.hm.get_track_stream('2fv7a'),
+                         'http://cdn/2fv7a.mp3')
+        self.assertEqual(self.hm.get_track_stream('2h8bn'),
+                         'http://cdn/2h8bn.mp3')
+        self.assertEqual(self.hm.get_track_stream('2cbxm'), '')
+
+    def test_soup(self):
+        soup = self.hm._get_soup('http://hypem.com/track/2fv7a')
+        self.assertEqual(soup.find('h3', 'track_name').a.text,
+                         'Rather Bright')
+
+
+if __name__ == '__main__':
+    unittest.main()
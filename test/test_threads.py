@@ -0,0 +1,141 @@
+'''Stress tests of one HypeM client shared by many threads'''
+import json
+import random
+import threading
+import unittest
+from urllib.parse import parse_qs, urlparse
+from HypeMCache import MISSING, MemoryCache
+from HypeMTransport import RequestsTransport
+from fakes import make_client
+
+THREADS = 16
+ROUNDS = 200
+
+
+def run_threads(target, count=THREADS):
+    '''Runs target(i) on count threads at once, re-raising the first error'''
+    errors = []
+    barrier = threading.Barrier(count)
+
+    def run(i):
+        barrier.wait()
+        try:
+            target(i)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def echo(method, url, kwargs):
+    '''Answers with the path and token of the request'''
+    parsed = urlparse(url)
+    token = parse_qs(parsed.query).get('hm_token', [''])[0]
+    return json.dumps({'path': parsed.path, 'hm_token': token})
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_stress(self):
+        "Concurrent reads, writes, deletes and listings stay consistent"
+        cache = MemoryCache(stripes=4)
+
+        def work(i):
+            rng = random.Random(i)
+            for _ in range(ROUNDS * 5):
+                key = ('m', str(rng.randrange(50)), ())
+                action = rng.random()
+                if action < 0.4:
+                    cache.set(key, key[1], rng.choice([60, -1]))
+                elif action < 0.8:
+                    value = cache.get(key)
+                    self.assertIn(value, (MISSING, key[1]))
+                elif action < 0.95:
+                    cache.delete(key)
+                else:
+                    for key in cache.keys():
+                        self.assertEqual(key[0], 'm')
+        run_threads(work)
+        self.assertLessEqual(len(cache), 50)
+
+
+class TestSharedClient(unittest.TestCase):
+
+    def setUp(self):
+        self.hm = make_client({'me/': echo, 'get_token': echo},
+                              hm_token='token-0')
+
+    def test_explicit_tokens(self):
+        "Results and invalidations never mix up the tokens of threads"
+        hm = self.hm
+
+        def work(i):
+            token = 'token-%d' % i
+            for n in range(ROUNDS):
+                self.assertEqual(hm.favorites_me(hm_token=token)['hm_token'],
+                                 token)
+                if n % 10 == 0:
+                    hm.toggle_favorite('item', 'x', hm_token=token)
+                    hm.log_user_action('listen', 'x', 1, hm_token=token)
+                    hm.remove_playlist(0, 'x', hm_token=token)
+        run_threads(work)
+        for method, url, data in hm._session.calls:
+            if method != 'GET':
+                self.assertEqual(parse_qs(urlparse(url).query)['hm_token'],
+                                 [data['hm_token']])
+
+    def test_changing_token(self):
+        "A token changed by get_token on one thread applies whole calls"
+        hm = self.hm
+        tokens = ['token-%d' % i for i in range(4)]
+
+        def work(i):
+            for n in range(ROUNDS):
+                if i == 0:
+                    hm.hm_token = tokens[n % len(tokens)]
+                    continue
+                result = hm.favorites_me()
+                self.assertIn(result['hm_token'], tokens)
+                hm.toggle_favorite('item', 'x')
+        run_threads(work)
+        for method, url, data in hm._session.calls:
+            if method == 'POST':
+                self.assertEqual(parse_qs(urlparse(url).query)['hm_token'],
+                                 [data['hm_token']])
+
+    def test_invalidation(self):
+        "Invalidations from other threads only drop their own token's entries"
+        hm = self.hm
+        hm.favorites_me(hm_token='kept')
+        run_threads(lambda i: [hm.toggle_favorite('item', 'x',
+                                                  hm_token='token-%d' % i)
+                               for _ in range(20)])
+        calls = len(hm._session.calls)
+        hm.favorites_me(hm_token='kept')
+        self.assertEqual(len(hm._session.calls), calls)
+
+
+class TestRequestsTransport(unittest.TestCase):
+
+    def test_per_thread(self):
+        "per_thread sessions differ by thread and share connection pools"
+        transport = RequestsTransport(pool_maxsize=4, per_thread=True)
+        transport.session.headers['X-Test'] = 'yes'
+        sessions = []
+        run_threads(lambda i: sessions.append(transport._thread_session()),
+                    count=4)
+        self.assertEqual(len(set(map(id, sessions))), 4)
+        for session in sessions:
+            self.assertIs(session.adapters, transport.session.adapters)
+            self.assertEqual(session.headers['X-Test'], 'yes')
+        transport.close()
+
+
+if __name__ == '__main__':
+    unittest.main()